@@ -0,0 +1,811 @@
+"""
+Analyses of synchronization events, reported at the end of a run.
+
+An analysis observes the model like a view: the model calls timestamp() on
+each status change of an event, and link() and group() for the relations it
+finds between events. At the end of the run, report() returns a summary
+that can be serialized as JSON, and printReport() renders the summary as
+tables. The summaries of a run are saved keyed by analysis name, so
+"sync-prof report" can print the tables again, sorted by another column.
+"""
+
+
+import bisect
+import json
+
+from sp_util import BLOCKING_FUNCTIONS, LOCK_FUNCTIONS, SPBlockedThreads, SPHistogram, \
+    lockFailed
+
+
+# analyses run if only a report file is given
+DEFAULT_ANALYSES = ['locks']
+# number of rows printed per table by default
+TOP_ROWS = 20
+# number of call sites reported per lock
+TOP_SITES = 5
+
+
+def analyses(names, stacks, timing):
+    "instances of the analyses with names"
+    return [ANALYSES[name](stacks, timing) for name in names]
+
+
+def reports(analyses):
+    "dict of the reports of analyses keyed by their names"
+    return dict((analysis.name, analysis.report()) for analysis in analyses)
+
+
+def writeReport(reports, fileName):
+    "save reports as JSON"
+    with open(fileName, 'w') as f:
+        json.dump(reports, f, indent=1, sort_keys=True)
+
+
+def readReport(fileName):
+    "reports saved by writeReport()"
+    with open(fileName, 'r') as f:
+        return json.load(f)
+
+
+def printReport(reports, out, sort=None, top=TOP_ROWS):
+    "print the tables of reports sorted by column sort, top rows at most"
+    for name in sorted(reports):
+        ANALYSES[name].printReport(reports[name], out, sort, top)
+
+
+class SPAnalysis(object):
+    "observer of the model's events with a report at the end of the run"
+    name = None
+    callSites = False # True if the report names the callers, so it needs backtraces
+    def __init__(self, stacks, timing):
+        self.stacks = stacks # SPStackTable of the event backtraces
+        self.unit = 'us' if timing else 'steps'
+    def close(self):
+        pass
+    def timestamp(self, pendEvents, event=None):
+        pass
+    def link(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        pass
+    def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        pass
+    def mark(self, name, category, scope, time, thread):
+        pass
+    def report(self):
+        "summary of the analysis as a dict of JSON types"
+        return {}
+    @staticmethod
+    def printReport(report, out, sort, top):
+        "print report as a table"
+        pass
+    def callSite(self, event):
+        """name of the frame calling the sync function of event, or '?'
+
+        Stacks of the GDB collector start in the sync function, those of the
+        preload collector in its caller.
+        """
+        if event.evBacktrace is None:
+            return '?'
+        names = self.stacks.names(event.evBacktrace)
+        return names[1] if len(names) > 1 else names[0]
+
+
+class SPLockStat(object):
+    "contention counters of a lock"
+    __slots__ = ['kind', 'acquisitions', 'sharedAcquisitions', 'contended', 'failed',
+                 'aborted', 'waiting', 'waitingWriters', 'held', 'heldShared', 'maxWaiters',
+                 'wait', 'hold', 'sharedHold', 'writers', 'maxReadsPassing', 'starved',
+                 'sites']
+    def __init__(self, kind):
+        self.kind = kind # mutex, rwlock or spinlock
+        self.acquisitions = 0
+        self.sharedAcquisitions = 0 # read locks of reader/writer locks
+        self.contended = 0 # calls finding the lock held or waited for
+        self.failed = 0 # failed trylocks and timed out locks
+        self.aborted = 0 # calls that never returned, e.g. in a deadlock
+        self.waiting = 0 # pending calls
+        self.waitingWriters = 0 # pending exclusive calls
+        self.held = 0 # exclusive holders
+        self.heldShared = 0
+        self.maxWaiters = 0
+        self.wait = SPHistogram() # duration of the lock calls, spin time of spinlocks
+        self.hold = SPHistogram() # exclusive holds from the lock's return to the unlock
+        self.sharedHold = SPHistogram()
+        self.writers = {} # pending exclusive call -> read locks granted meanwhile
+        self.maxReadsPassing = 0
+        self.starved = 0 # writers passed by at least STARVATION_READS read locks
+        self.sites = {} # call site -> [calls, wait]
+
+
+# read locks granted while a writer waits that make it count as starved
+STARVATION_READS = 8
+
+
+class SPLockStats(SPAnalysis):
+    """acquisitions, wait and hold times, waiters and call sites per lock
+
+    Mutexes, reader/writer locks and spinlocks are reported; the wait of a
+    spinlock is its spin time. A read lock is contended if a writer holds
+    the lock or waits for it, other locks if anyone does. For reader/writer
+    locks, the read locks granted while a writer waits show writer
+    starvation. Times are in microseconds with native timing, in model
+    steps otherwise.
+    """
+    name = 'locks'
+    callSites = True
+    sortKeys = {'lock': lambda l: l['lock'],
+                'acquisitions': lambda l: -l['acquisitions'],
+                'contended': lambda l: -l['contended'],
+                'wait': lambda l: -l['wait']['total'],
+                'hold': lambda l: -l['hold']['total'],
+                'waiters': lambda l: -l['maxWaiters'],
+                'starved': lambda l: -l['starvedWriters']}
+
+    def __init__(self, stacks, timing):
+        super(SPLockStats, self).__init__(stacks, timing)
+        self.locks = {} # lock -> SPLockStat
+
+    def timestamp(self, pendEvents, event=None):
+        "count lock calls"
+        if event is None or event.evName not in LOCK_FUNCTIONS:
+            return
+        _unlockName, kind, mode = LOCK_FUNCTIONS[event.evName]
+        shared = mode == 'shared'
+        stat = self.locks.get(event.evArg1)
+        if stat is None:
+            stat = self.locks[event.evArg1] = SPLockStat(kind)
+        if event.status == 'started':
+            if stat.held > 0 or stat.waitingWriters > 0 or \
+                    (not shared and (stat.waiting > 0 or stat.heldShared > 0)):
+                stat.contended += 1
+            stat.waiting += 1
+            stat.maxWaiters = max(stat.maxWaiters, stat.waiting)
+            if not shared:
+                stat.waitingWriters += 1
+                if kind == 'rwlock':
+                    stat.writers[event] = 0
+            return
+        stat.waiting -= 1
+        if not shared:
+            stat.waitingWriters -= 1
+            readsPassing = stat.writers.pop(event, 0)
+            stat.maxReadsPassing = max(stat.maxReadsPassing, readsPassing)
+            if readsPassing >= STARVATION_READS:
+                stat.starved += 1
+        if event.status != 'finished':
+            stat.aborted += 1
+            return
+        wait = event.stopTime - event.startTime
+        stat.wait.add(wait)
+        site = stat.sites.setdefault(self.callSite(event), [0, 0])
+        site[0] += 1
+        site[1] += wait
+        if lockFailed(event):
+            stat.failed += 1
+        elif shared:
+            stat.heldShared += 1
+            stat.sharedAcquisitions += 1
+            for writer in stat.writers:
+                stat.writers[writer] += 1
+        else:
+            stat.held += 1
+            stat.acquisitions += 1
+
+    def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        "measure the lock blocks"
+        if 'lock' not in args or args['lock'] not in self.locks:
+            return
+        stat = self.locks[args['lock']]
+        if args.get('mode') == 'shared':
+            stat.heldShared = max(stat.heldShared - 1, 0)
+            stat.sharedHold.add(stopTime - startTime)
+        else:
+            stat.held = max(stat.held - 1, 0)
+            stat.hold.add(stopTime - startTime)
+
+    def report(self):
+        locks = []
+        for lock, stat in self.locks.items():
+            sites = sorted(stat.sites.items(), key=lambda s: (-s[1][1], -s[1][0], s[0]))
+            locks.append({'lock': str(lock),
+                          'kind': stat.kind,
+                          'acquisitions': stat.acquisitions + stat.sharedAcquisitions,
+                          'sharedAcquisitions': stat.sharedAcquisitions,
+                          'contended': stat.contended,
+                          'failed': stat.failed,
+                          'aborted': stat.aborted,
+                          'maxWaiters': stat.maxWaiters,
+                          'wait': stat.wait.summary(),
+                          'hold': stat.hold.summary(),
+                          'sharedHold': stat.sharedHold.summary(),
+                          'maxReadsPassing': stat.maxReadsPassing,
+                          'starvedWriters': stat.starved,
+                          'callSites': [{'site': site, 'calls': calls, 'wait': wait}
+                                        for site, (calls, wait) in sites[:TOP_SITES]]})
+        locks.sort(key=SPLockStats.sortKeys['wait'])
+        return {'unit': self.unit, 'locks': locks}
+
+    @staticmethod
+    def printReport(report, out, sort, top):
+        locks = sorted(report['locks'],
+                       key=SPLockStats.sortKeys.get(sort, SPLockStats.sortKeys['wait']))
+        if not locks:
+            return
+        row = '{:<30}{:<10}{:>8}{:>8}{:>10}{:>8}{:>8}{:>8}{:>10}{:>8}{:>8}{:>8}{:>8}\n'
+        out.write('\nLock contention (times in %s):\n' % report['unit'])
+        out.write(row.format('lock', 'kind', 'acq', 'cont', 'wait', 'p50', 'p99', 'max',
+                             'hold', 'p50', 'p99', 'max', 'waiters'))
+        for l in locks[:top]:
+            wait, hold = l['wait'], l['hold']
+            out.write(row.format(l['lock'], l['kind'], l['acquisitions'], l['contended'],
+                                 wait['total'], wait['p50'], wait['p99'], wait['max'],
+                                 hold['total'], hold['p50'], hold['p99'], hold['max'],
+                                 l['maxWaiters']))
+        rwlocks = [l for l in locks[:top] if l['kind'] == 'rwlock']
+        if rwlocks:
+            row = '{:<30}{:>8}{:>8}{:>10}{:>8}{:>8}{:>10}{:>10}\n'
+            out.write('\nReader/writer locks (times in %s):\n' % report['unit'])
+            out.write(row.format('lock', 'reads', 'writes', 'shared', 'p99', 'max',
+                                 'passing', 'starved'))
+            for l in rwlocks:
+                shared = l['sharedHold']
+                out.write(row.format(l['lock'], l['sharedAcquisitions'],
+                                     l['acquisitions'] - l['sharedAcquisitions'],
+                                     shared['total'], shared['p99'], shared['max'],
+                                     l['maxReadsPassing'], l['starvedWriters']))
+        out.write('\nTop contending call sites:\n')
+        for l in locks[:top]:
+            for site in l['callSites']:
+                out.write('{:<30}{:>8} calls{:>10} {} {}\n'.format(
+                    l['lock'], site['calls'], site['wait'], report['unit'], site['site']))
+
+
+class SPBarrierStat(object):
+    "phase counters of a barrier"
+    __slots__ = ['phases', 'team', 'arrivals', 'wait', 'skew', 'stragglers']
+    def __init__(self):
+        self.phases = 0
+        self.team = 0 # largest number of threads of a phase
+        self.arrivals = [] # pending waits of the current phase in the order of arrival
+        self.wait = SPHistogram()
+        self.skew = SPHistogram() # from the first to the last arrival of a phase
+        self.stragglers = {} # thread -> phases it arrived last
+
+
+class SPBarrierStats(SPAnalysis):
+    """phases, arrival skew and stragglers per pthread barrier
+
+    A phase consists of the waits pending when the first of them returns,
+    since the barrier opens only after the last thread arrives. The skew
+    of a phase is the time from its first to its last arrival, which the
+    earlier threads spend waiting for the straggler.
+    """
+    name = 'barriers'
+    sortKeys = {'barrier': lambda b: b['barrier'],
+                'phases': lambda b: -b['phases'],
+                'wait': lambda b: -b['wait']['total'],
+                'skew': lambda b: -b['skew']['total']}
+
+    def __init__(self, stacks, timing):
+        super(SPBarrierStats, self).__init__(stacks, timing)
+        self.barriers = {} # barrier -> SPBarrierStat
+
+    def timestamp(self, pendEvents, event=None):
+        "collect the phases"
+        if event is None or event.evName != 'pthread_barrier_wait':
+            return
+        stat = self.barriers.get(event.evArg1)
+        if stat is None:
+            stat = self.barriers[event.evArg1] = SPBarrierStat()
+        if event.status == 'started':
+            stat.arrivals.append(event)
+            return
+        if event.status != 'finished':
+            return
+        stat.wait.add(event.stopTime - event.startTime)
+        if event not in stat.arrivals:
+            return # a later return of a finished phase
+        first, last = stat.arrivals[0], stat.arrivals[-1]
+        stat.phases += 1
+        stat.team = max(stat.team, len(stat.arrivals))
+        stat.skew.add(last.startTime - first.startTime)
+        stat.stragglers[last.evThread] = stat.stragglers.get(last.evThread, 0) + 1
+        stat.arrivals = []
+
+    def report(self):
+        barriers = []
+        for barrier, stat in self.barriers.items():
+            stragglers = sorted(stat.stragglers.items(), key=lambda s: (-s[1], s[0]))
+            barriers.append({'barrier': str(barrier),
+                             'phases': stat.phases,
+                             'team': stat.team,
+                             'wait': stat.wait.summary(),
+                             'skew': stat.skew.summary(),
+                             'stragglers': [{'thread': thread, 'phases': phases}
+                                            for thread, phases in stragglers[:TOP_SITES]]})
+        barriers.sort(key=SPBarrierStats.sortKeys['skew'])
+        return {'unit': self.unit, 'barriers': barriers}
+
+    @staticmethod
+    def printReport(report, out, sort, top):
+        barriers = sorted(report['barriers'],
+                          key=SPBarrierStats.sortKeys.get(sort, SPBarrierStats.sortKeys['skew']))
+        if not barriers:
+            return
+        row = '{:<30}{:>8}{:>6}{:>10}{:>10}{:>8}{:>8}{:>8}{:>12}\n'
+        out.write('\nBarrier phases (times in %s):\n' % report['unit'])
+        out.write(row.format('barrier', 'phases', 'team', 'wait', 'skew', 'p50', 'p99',
+                             'max', 'straggler'))
+        for b in barriers[:top]:
+            skew = b['skew']
+            straggler = b['stragglers'][0] if b['stragglers'] else None
+            out.write(row.format(b['barrier'], b['phases'], b['team'], b['wait']['total'],
+                                 skew['total'], skew['p50'], skew['p99'], skew['max'],
+                                 '%d (%dx)' % (straggler['thread'], straggler['phases'])
+                                 if straggler else '-'))
+
+
+class SPCondStat(object):
+    "signal and wake-up counters of a condition variable"
+    __slots__ = ['waits', 'signals', 'broadcasts', 'wasted', 'timeouts', 'unsignaled',
+                 'fanOut', 'latency', 'reacquire']
+    def __init__(self):
+        self.waits = 0
+        self.signals = 0
+        self.broadcasts = 0
+        self.wasted = 0 # signals and broadcasts waking no waiter
+        self.timeouts = 0
+        self.unsignaled = 0 # waits returning without a signal, e.g. spurious wake-ups
+        self.fanOut = SPHistogram() # waiters woken per broadcast
+        self.latency = SPHistogram() # from the signal to the return of the wait
+        self.reacquire = SPHistogram() # part of the latency the mutex was held by others
+
+
+class SPCondStats(SPAnalysis):
+    """signals, wasted signals, broadcast fan-out and wake-up latency per
+    condition variable
+
+    The latency of a wait runs from the signal linked to it to its return.
+    Its first part lasts until the last release of the wait's mutex, as the
+    wait has to re-acquire the mutex before returning. That part grows when
+    a broadcast wakes many waiters for one mutex, or when the signaling
+    thread keeps holding the mutex.
+    """
+    name = 'condvars'
+    signalNames = ['pthread_cond_signal', 'pthread_cond_broadcast']
+    waitNames = ['pthread_cond_wait', 'pthread_cond_timedwait']
+    sortKeys = {'condvar': lambda c: c['condvar'],
+                'waits': lambda c: -c['waits'],
+                'signals': lambda c: -(c['signals'] + c['broadcasts']),
+                'wasted': lambda c: -c['wasted'],
+                'latency': lambda c: -c['latency']['total'],
+                'reacquire': lambda c: -c['reacquire']['total']}
+
+    def __init__(self, stacks, timing):
+        super(SPCondStats, self).__init__(stacks, timing)
+        self.pendEvents = {}
+        self.conds = {} # condition variable -> SPCondStat
+        self.woken = {} # pending signal -> waits woken
+        self.signals = {} # pending wait -> time of the signal waking it
+        self.released = {} # mutex -> time of its last unlock
+
+    def stat(self, cond):
+        "counters of cond"
+        stat = self.conds.get(cond)
+        if stat is None:
+            stat = self.conds[cond] = SPCondStat()
+        return stat
+
+    def timestamp(self, pendEvents, event=None):
+        "count signals and measure the waits"
+        if event is None:
+            return
+        self.pendEvents = pendEvents
+        if event.evName in self.signalNames:
+            if event.status == 'started':
+                self.woken[event] = 0
+                return
+            woken = self.woken.pop(event, 0)
+            if event.status != 'finished':
+                return
+            stat = self.stat(event.evArg1)
+            if event.evName == 'pthread_cond_broadcast':
+                stat.broadcasts += 1
+                stat.fanOut.add(woken)
+            else:
+                stat.signals += 1
+            if woken == 0:
+                stat.wasted += 1
+        elif event.evName in self.waitNames and event.status != 'started':
+            signal = self.signals.pop(event, None)
+            if event.status != 'finished':
+                return
+            stat = self.stat(event.evArg1)
+            stat.waits += 1
+            if lockFailed(event):
+                stat.timeouts += 1
+            elif signal is None:
+                stat.unsignaled += 1
+            else:
+                stat.latency.add(event.stopTime - signal)
+                released = self.released.get(event.evArg2, signal)
+                stat.reacquire.add(min(released, event.stopTime) - signal)
+
+    def link(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        "pair signals with the waits they wake"
+        if name != 'condition satisfied':
+            return
+        signal = self.topEvent(startThread)
+        if signal in self.woken:
+            self.woken[signal] += 1
+        wait = self.topEvent(stopThread)
+        if wait is not None and wait.evName in self.waitNames:
+            self.signals[wait] = startTime
+
+    def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        "remember the unlocks of the mutexes"
+        if 'lock' in args:
+            self.released[args['lock']] = stopTime
+
+    def topEvent(self, thread):
+        "event on the top of the stack of thread, or None"
+        events = self.pendEvents.get(thread, {}).get('events')
+        if events is None or events.empty():
+            return None
+        return events.top()
+
+    def report(self):
+        conds = []
+        for cond, stat in self.conds.items():
+            conds.append({'condvar': str(cond),
+                          'waits': stat.waits,
+                          'signals': stat.signals,
+                          'broadcasts': stat.broadcasts,
+                          'wasted': stat.wasted,
+                          'timeouts': stat.timeouts,
+                          'unsignaled': stat.unsignaled,
+                          'fanOut': stat.fanOut.summary(),
+                          'latency': stat.latency.summary(),
+                          'reacquire': stat.reacquire.summary()})
+        conds.sort(key=SPCondStats.sortKeys['latency'])
+        return {'unit': self.unit, 'condvars': conds}
+
+    @staticmethod
+    def printReport(report, out, sort, top):
+        conds = sorted(report['condvars'],
+                       key=SPCondStats.sortKeys.get(sort, SPCondStats.sortKeys['latency']))
+        if not conds:
+            return
+        row = '{:<30}{:>8}{:>8}{:>8}{:>8}{:>8}{:>10}{:>8}{:>8}{:>10}{:>8}{:>8}\n'
+        out.write('\nCondition variables (times in %s):\n' % report['unit'])
+        out.write(row.format('condvar', 'waits', 'signals', 'bcasts', 'wasted', 'fanout',
+                             'latency', 'p50', 'p99', 'reacquire', 'p99', 'nosig'))
+        for c in conds[:top]:
+            latency, reacquire = c['latency'], c['reacquire']
+            out.write(row.format(c['condvar'], c['waits'], c['signals'], c['broadcasts'],
+                                 c['wasted'], c['fanOut']['max'], latency['total'],
+                                 latency['p50'], latency['p99'], reacquire['total'],
+                                 reacquire['p99'], c['unsignaled']))
+
+
+class SPCriticalPath(SPAnalysis):
+    """critical path from the program start to the end of the last thread
+
+    The path is walked backwards from the last event. On each thread, it
+    goes back to the latest wait that blocked until another thread woke it
+    by a link (lock released, semaphore increment, condition satisfied,
+    barrier reached, thread finished). From there it continues on the waking
+    thread at the time of the wake-up. At the start of a thread, it
+    continues on the creating thread at the clone. The path consists of
+    the running segments of threads and the hand-off times of the waits
+    between them, which together add up to the runtime. The analysis keeps
+    the blocked waits and lock blocks until the end, so it takes memory
+    proportional to the number of contended events.
+    """
+    name = 'critical-path'
+    waitSortKeys = {'count': lambda w: -w['count'],
+                    'blocked': lambda w: -w['blocked'],
+                    'handoff': lambda w: -w['handoff']}
+
+    def __init__(self, stacks, timing):
+        super(SPCriticalPath, self).__init__(stacks, timing)
+        self.pendEvents = {}
+        self.firstTime = {} # thread -> time of its first event
+        self.lastTime = {} # thread -> time of its last event
+        self.creators = {} # thread -> (creating thread, time of the clone)
+        self.wakers = {} # pending event -> (waking thread, time of the wake-up)
+        self.waits = {} # thread -> list of blocked waits in the order of their end
+        self.waitStops = {} # thread -> list of the ends of the blocked waits
+        self.lockBlocks = [] # (thread, start, stop, lock)
+
+    def timestamp(self, pendEvents, event=None):
+        "track the thread lifetimes and the ends of the woken waits"
+        if event is None:
+            return
+        self.pendEvents = pendEvents
+        thread = event.evThread
+        if event.status == 'started':
+            self.firstTime.setdefault(thread, event.startTime)
+            self.lastTime[thread] = event.startTime
+            return
+        waker = self.wakers.pop(event, None)
+        if event.status != 'finished':
+            return # aborted at the end
+        self.lastTime[thread] = event.stopTime
+        if waker is not None:
+            self.addWait(event, waker)
+
+    def addWait(self, event, waker):
+        "add the finished event woken by waker if it blocked until the waker"
+        if event.startTime < waker[1] < event.stopTime:
+            thread = event.evThread
+            self.waits.setdefault(thread, []).append((event.startTime,
+                                                      event.stopTime,
+                                                      waker[0],
+                                                      waker[1],
+                                                      event.evName,
+                                                      str(event.evArg1)))
+            self.waitStops.setdefault(thread, []).append(event.stopTime)
+
+    def link(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        "remember the latest waker of the event pending at the end of a link"
+        if name == 'thread started':
+            self.creators[stopThread] = (startThread, startTime)
+            return
+        if name == 'thread finished':
+            # the link starts just before the join returns, not at the thread's end
+            startTime = self.lastTime.get(startThread, startTime)
+        events = self.pendEvents.get(stopThread, {}).get('events')
+        if events is None or events.empty():
+            return
+        event = events.top()
+        if event.status == 'finished':
+            # joins are linked when they return
+            self.addWait(event, (startThread, startTime))
+        else:
+            self.wakers[event] = (startThread, startTime)
+
+    def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        "remember the lock blocks"
+        if 'lock' in args:
+            self.lockBlocks.append((startThread, startTime, stopTime, str(args['lock'])))
+
+    def walk(self):
+        """return the segments of the path as (thread, start, stop) and the
+        crossed waits, both from the end backwards"""
+        segments = []
+        waits = []
+        if not self.lastTime:
+            return segments, waits
+        thread = max(self.lastTime, key=lambda t: (self.lastTime[t], -t))
+        time = self.lastTime[thread]
+        while True:
+            start = self.firstTime[thread]
+            stops = self.waitStops.get(thread, [])
+            i = bisect.bisect_right(stops, time) - 1
+            if i >= 0 and stops[i] >= start:
+                wait = self.waits[thread][i]
+                segments.append((thread, wait[1], time))
+                waits.append(wait)
+                thread, time = wait[2], wait[3]
+                continue
+            segments.append((thread, start, time))
+            creator = self.creators.get(thread)
+            if creator is None or creator[0] not in self.firstTime or creator[1] >= start:
+                break
+            # the start of a thread counts as a wait for its creation
+            waits.append((creator[1], start, creator[0], creator[1], 'thread start',
+                          str(thread)))
+            thread, time = creator
+        return segments, waits
+
+    def report(self):
+        segments, waits = self.walk()
+        if not segments:
+            return {'unit': self.unit, 'length': 0, 'threads': [], 'waits': [], 'locks': []}
+        end = segments[0][2]
+        length = end - segments[-1][1]
+        threads = {}
+        for thread, start, stop in segments:
+            threads[thread] = threads.get(thread, 0) + stop - start
+        byObject = {}
+        for start, stop, waker, wakeTime, name, obj in waits:
+            w = byObject.setdefault((name, obj), {'wait': name, 'object': obj, 'count': 0,
+                                                  'blocked': 0, 'handoff': 0})
+            w['count'] += 1
+            w['blocked'] += stop - start
+            w['handoff'] += stop - wakeTime
+        return {'unit': self.unit,
+                'length': length,
+                'lastThread': segments[0][0],
+                'threads': [{'thread': t, 'running': running}
+                            for t, running in sorted(threads.items())],
+                'waits': sorted(byObject.values(), key=SPCriticalPath.waitSortKeys['handoff']),
+                'locks': self.locksOnPath(segments)}
+
+    def locksOnPath(self, segments):
+        "time the path spends holding each lock, longest first"
+        byThread = {}
+        for thread, start, stop in segments:
+            byThread.setdefault(thread, []).append((start, stop))
+        ends = {}
+        for thread, threadSegments in byThread.items():
+            threadSegments.sort()
+            # segments are disjoint, so their ends are sorted too
+            ends[thread] = [s[1] for s in threadSegments]
+        held = {}
+        for thread, start, stop, lock in self.lockBlocks:
+            threadSegments = byThread.get(thread, [])
+            i = bisect.bisect_right(ends.get(thread, []), start)
+            while i < len(threadSegments) and threadSegments[i][0] < stop:
+                overlap = min(stop, threadSegments[i][1]) - max(start, threadSegments[i][0])
+                held[lock] = held.get(lock, 0) + max(overlap, 0)
+                i += 1
+        return [{'lock': lock, 'held': time}
+                for lock, time in sorted(held.items(), key=lambda l: (-l[1], l[0]))
+                if time > 0]
+
+    @staticmethod
+    def printReport(report, out, sort, top):
+        length = report['length']
+        if length <= 0:
+            return
+        percent = lambda time: 100.0 * time / length
+        out.write('\nCritical path: %d %s to the end of thread %d\n' % \
+                      (length, report['unit'], report['lastThread']))
+        row = '{:<30}{:>10}{:>8.1f}%\n'
+        out.write('{:<30}{:>10}{:>9}\n'.format('thread', 'running', 'path'))
+        for t in report['threads']:
+            out.write(row.format(t['thread'], t['running'], percent(t['running'])))
+        waits = sorted(report['waits'], key=SPCriticalPath.waitSortKeys.get(
+            sort, SPCriticalPath.waitSortKeys['handoff']))
+        if waits:
+            out.write('\nWaits on the critical path:\n')
+            out.write('{:<30}{:<20}{:>8}{:>10}{:>10}{:>9}\n'.format(
+                'wait', 'object', 'count', 'blocked', 'handoff', 'path'))
+            for w in waits[:top]:
+                out.write('{:<30}{:<20}{:>8}{:>10}{:>10}{:>8.1f}%\n'.format(
+                    w['wait'], w['object'], w['count'], w['blocked'], w['handoff'],
+                    percent(w['handoff'])))
+        if report['locks']:
+            out.write('\nLocks held on the critical path:\n')
+            out.write('{:<30}{:>10}{:>9}\n'.format('lock', 'held', 'path'))
+            for l in report['locks'][:top]:
+                out.write(row.format(l['lock'], l['held'], percent(l['held'])))
+
+
+class SPOpenMP(SPAnalysis):
+    """team, chunks, barrier wait and load imbalance per OpenMP parallel region
+
+    The model emits a group per thread of each finished region. The work of
+    a thread is the region time minus its barrier wait, and the imbalance is
+    the maximum work divided by the mean work of the team (1 is balanced).
+    Only threads calling the OpenMP runtime in a region are seen, e.g. not
+    the threads of a statically scheduled loop.
+    """
+    name = 'openmp'
+    sortKeys = {'region': lambda r: r['region'],
+                'time': lambda r: -r['time'],
+                'chunks': lambda r: -r['chunks'],
+                'barrier': lambda r: -r['barrierWait'],
+                'imbalance': lambda r: -r['imbalance']}
+
+    def __init__(self, stacks, timing):
+        super(SPOpenMP, self).__init__(stacks, timing)
+        self.regions = {} # region number -> report of the region
+
+    def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        "collect the threads of the regions"
+        if category != 'OpenMP':
+            return
+        region = self.regions.setdefault(args['region'], {'region': args['region'],
+                                                          'master': args['master'],
+                                                          'team': args['team'],
+                                                          'time': stopTime - startTime,
+                                                          'threads': []})
+        region['threads'].append({'thread': startThread,
+                                  'chunks': args['chunks'],
+                                  'barrierWait': args['barrier wait'],
+                                  'work': max(stopTime - startTime - args['barrier wait'], 0)})
+
+    def report(self):
+        regions = []
+        for number in sorted(self.regions):
+            region = self.regions[number]
+            work = [t['work'] for t in region['threads']]
+            mean = float(sum(work)) / len(work)
+            region['chunks'] = sum(t['chunks'] for t in region['threads'])
+            region['barrierWait'] = sum(t['barrierWait'] for t in region['threads'])
+            region['imbalance'] = round(max(work) / mean, 3) if mean > 0 else 1.0
+            regions.append(region)
+        return {'unit': self.unit, 'regions': regions}
+
+    @staticmethod
+    def printReport(report, out, sort, top):
+        regions = sorted(report['regions'],
+                         key=SPOpenMP.sortKeys.get(sort, SPOpenMP.sortKeys['time']))
+        if not regions:
+            return
+        row = '{:<10}{:>8}{:>6}{:>10}{:>8}{:>10}{:>10}\n'
+        out.write('\nOpenMP parallel regions (times in %s):\n' % report['unit'])
+        out.write(row.format('region', 'master', 'team', 'time', 'chunks', 'barrier',
+                             'imbalance'))
+        for r in regions[:top]:
+            out.write(row.format(r['region'], r['master'], r['team'], r['time'],
+                                 r['chunks'], r['barrierWait'], '%.2f' % r['imbalance']))
+            for t in r['threads']:
+                out.write('  thread {:<10}{:>8} chunks{:>10} work{:>10} barrier\n'.format(
+                    t['thread'], t['chunks'], t['work'], t['barrierWait']))
+
+
+class SPUtilization(SPAnalysis):
+    """running and blocked time per thread
+
+    A thread lives from its first to its last event. It is blocked while
+    a blocking call is pending, by the primitive of the call (see
+    SPBlockedThreads), and running otherwise. Threads of a pool that are
+    blocked most of the time suggest that the pool is oversized, while
+    threads hardly ever blocked suggest that it is starved.
+    """
+    name = 'utilization'
+    sortKeys = {'thread': lambda t: t['thread'],
+                'lifetime': lambda t: -t['lifetime'],
+                'running': lambda t: -t['running'],
+                'blocked': lambda t: -sum(t['blocked'].values())}
+
+    def __init__(self, stacks, timing):
+        super(SPUtilization, self).__init__(stacks, timing)
+        self.blocked = SPBlockedThreads()
+        self.maxBlocked = 0
+        self.firstTime = {} # thread -> time of its first event
+        self.lastTime = {} # thread -> time of its last event
+        self.blockedTime = {} # thread -> primitive -> time
+
+    def timestamp(self, pendEvents, event=None):
+        "track the thread lifetimes and the blocking calls"
+        if event is None:
+            return
+        thread = event.evThread
+        time = event.startTime if event.status == 'started' else event.stopTime
+        self.firstTime.setdefault(thread, event.startTime)
+        self.lastTime[thread] = max(self.lastTime.get(thread, time), time)
+        if not self.blocked.update(event):
+            return
+        if event.status == 'started':
+            self.maxBlocked = max(self.maxBlocked, len(self.blocked.blocking))
+            return
+        times = self.blockedTime.setdefault(thread, {})
+        primitive = BLOCKING_FUNCTIONS[event.evName]
+        times[primitive] = times.get(primitive, 0) + event.stopTime - event.startTime
+
+    def report(self):
+        threads = []
+        for thread in sorted(self.firstTime):
+            lifetime = self.lastTime[thread] - self.firstTime[thread]
+            blocked = self.blockedTime.get(thread, {})
+            threads.append({'thread': thread,
+                            'lifetime': lifetime,
+                            'running': max(lifetime - sum(blocked.values()), 0),
+                            'blocked': blocked})
+        return {'unit': self.unit, 'maxBlocked': self.maxBlocked, 'threads': threads}
+
+    @staticmethod
+    def printReport(report, out, sort, top):
+        threads = sorted(report['threads'],
+                         key=SPUtilization.sortKeys.get(sort, SPUtilization.sortKeys['thread']))
+        if not threads:
+            return
+        primitives = sorted(set(p for t in threads for p in t['blocked']))
+        row = '{:<10}{:>10}{:>10}{:>7}' + '{:>11}' * len(primitives) + '\n'
+        out.write('\nThread utilization (times in %s, at most %d threads blocked):\n' % \
+                      (report['unit'], report['maxBlocked']))
+        out.write(row.format('thread', 'lifetime', 'running', 'run', *primitives))
+        for t in threads[:top]:
+            run = 100.0 * t['running'] / t['lifetime'] if t['lifetime'] > 0 else 100.0
+            out.write(row.format(t['thread'], t['lifetime'], t['running'], '%.0f%%' % run,
+                                 *[t['blocked'].get(p, 0) for p in primitives]))
+
+
+# analyses by name
+ANALYSES = dict((analysis.name, analysis) for analysis in [SPLockStats, SPBarrierStats,
+                                                           SPCondStats, SPCriticalPath,
+                                                           SPOpenMP, SPUtilization])
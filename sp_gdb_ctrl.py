@@ -2,36 +2,121 @@
 
 
 import gdb
+import os
 import re
+import signal
+import struct
 import sys
+import threading
+
+
+# registers holding integer arguments and return values per architecture,
+# selected by the architecture name reported by GDB
+ABI = {'i386:x86-64': {'args': ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9'],
+                       'ret': 'rax'},
+       'aarch64': {'args': ['x0', 'x1', 'x2', 'x3', 'x4', 'x5', 'x6', 'x7'],
+                   'ret': 'x0'}}
+
+
+# default depth of PC-only backtraces
+BACKTRACE_DEPTH = 16
+
+# single steps timed to calibrate the cost of a stop
+CALIBRATION_STEPS = 20
+# round trips through GDB per breakpoint hit: the trap and the step over the
+# breakpoint when resuming
+TRIPS_PER_HIT = 2
+
+# functions whose first argument is the sync object for --only-objects
+OBJECT_FUNCTIONS = re.compile(r'^(pthread_(mutex|cond|rwlock|spin|barrier)_|sem_)')
+# functions whose second argument is a sync object as well
+SECOND_OBJECT_FUNCTIONS = ['pthread_cond_wait', 'pthread_cond_timedwait']
 
 
 debugMode = False
+nonStop = False
+abi = None
+backtraceDepth = None # None for unlimited
 spModel = None
+spClock = None
+spSymbolizer = None
+spWindow = None
+spReturns = None
 log = None
 
 
 def main():
     "entry point of the GDB script"
-    global outputFile, debugMode, log
+    global outputFile, debugMode, nonStop, log
     gdbSettings(debugMode)
-    configFile, outFile, userCommand, debugMode, outFormat, spDirName, logLevel = \
-        parseCmdLineArgs()
+    configFile, outFile, userCommand, debugMode, outFormat, spDirName, logLevel, timing, \
+        backtrace, attachPid, duration, maxEvents, onlyObjects, onlyThreads, analyses, \
+        reportFile, flightRecorder, nonStop = parseCmdLineArgs()
     # TODO: elegant solution to discover other sync-prof's modules
     sys.path += [spDirName]
+    global sp_symbols, sp_util
     import sp_util
     import sp_model
+    import sp_rawlog
+    import sp_symbols
     log = sp_util.setupLogging(logLevel)
+    if nonStop:
+        # only the thread hitting a breakpoint stops; must be set before the
+        # program runs. GDB still runs the stop handlers one at a time in its
+        # event loop, so the model gets the events in timestamp order, and a
+        # lock is taken only after the handler of its unlock resumed the owner.
+        gdb.execute('set non-stop on')
+        log.info('non-stop mode')
     # instantiate the model(outFormat)
-    global spModel
-    spModel = sp_model.SPModel(outFormat, outFile, log)
+    global spModel, spClock, spSymbolizer, spWindow, spReturns
+    spClock = sp_util.SPClock(allStop=not nonStop)
+    if outFormat == 'raw':
+        # the raw log is replayed through the model after the run, which also
+        # symbolizes the raw addresses in bulk
+        spModel = sp_rawlog.SPRawLogWriter(outFile, log)
+    else:
+        spModel = sp_model.SPModel(outFormat, outFile, log, timing, analyses, reportFile,
+                                   flightRecorder)
+        spSymbolizer = sp_symbols.SPSymbolizer(log)
+    setupBacktraces(backtrace)
+    # snapshot the memory map whenever the loaded binaries change
+    gdb.events.new_objfile.connect(snapshotMaps)
+    spWindow = SPCaptureWindow(duration, maxEvents,
+                               (flightRecorder or {}).get('watchdog'), nonStop)
+    gdb.events.stop.connect(spWindow.onStop)
+    spReturns = SPReturnProbes()
+    gdb.events.exited.connect(spReturns.onExited)
+    if hasattr(gdb.events, 'thread_exited'):
+        # GDB 14 and newer
+        gdb.events.thread_exited.connect(spReturns.onThreadExited)
+    if attachPid is not None:
+        gdb.execute('attach %d' % attachPid)
+        snapshotMaps()
     # run the analysis
     installBreakpoints(configFile, userCommand)
-    # TODO: weird issue: without it terminal gets corrupt at the end of execution
-    gdb.execute('start')
-    gdb.execute('run')
+    if attachPid is not None:
+        installFilters(onlyObjects, onlyThreads)
+        spWindow.open()
+        # attaching stopped all threads; in non-stop mode continue resumes only one
+        gdb.execute('continue -a' if nonStop else 'continue')
+    else:
+        # TODO: weird issue: without it terminal gets corrupt at the end of execution
+        gdb.execute('start')
+        snapshotMaps()
+        if not nonStop:
+            # run restarts the program, so the steps leave no trace
+            spClock.stopCost = TRIPS_PER_HIT * calibrateStop()
+            log.info('calibrated %.1f us per breakpoint hit' % (spClock.stopCost * 1e6))
+        # symbols of the objects are relocated now
+        installFilters(onlyObjects, onlyThreads)
+        spWindow.open()
+        gdb.execute('run')
+    spWindow.close()
     printSummary()
-    del spModel # should flush the output file buffers
+    if gdb.selected_inferior().pid != 0:
+        # the capture window ended before the program: let it run on
+        detachInferior()
+    spModel.close() # flushes the output file buffers
     gdb.execute('quit')
 
 
@@ -51,7 +136,44 @@ def parseCmdLineArgs():
     outFormat = getArg(5)
     spDirName = getArg(6)
     logLevel = int(getArg(7))
-    return configFile, outFile, userCommand, debug, outFormat, spDirName, logLevel
+    timing = eval(getArg(8))
+    backtrace = getArg(9)
+    attachPid = eval(getArg(10))
+    duration = eval(getArg(11))
+    maxEvents = eval(getArg(12))
+    onlyObjects = eval(getArg(13))
+    onlyThreads = eval(getArg(14))
+    analyses = eval(getArg(15))
+    reportFile = eval(getArg(16))
+    flightRecorder = eval(getArg(17))
+    nonStop = eval(getArg(18))
+    return configFile, outFile, userCommand, debug, outFormat, spDirName, logLevel, timing, \
+        backtrace, attachPid, duration, maxEvents, onlyObjects, onlyThreads, analyses, \
+        reportFile, flightRecorder, nonStop
+
+
+def calibrateStop():
+    """seconds of a round trip through GDB stopping the program
+
+    The stopped program is single-stepped with the sync breakpoints disabled,
+    so no events are recorded. A step costs a trap, context switches and
+    GDB's work as a breakpoint hit does, without the handler. Attached
+    programs are not calibrated, because a step may wait in a system call.
+    """
+    breakpoints = [bp for bp in traceFunctions() if bp.enabled]
+    for bp in breakpoints:
+        bp.enabled = False
+    try:
+        start = sp_util.clock()
+        for _i in range(CALIBRATION_STEPS):
+            gdb.execute('stepi', to_string=True)
+        return (sp_util.clock() - start) / CALIBRATION_STEPS
+    except gdb.error as e:
+        log.warning('cannot calibrate the stop cost: %s' % e)
+        return 0.0
+    finally:
+        for bp in breakpoints:
+            bp.enabled = True
 
 
 def gdbSettings(debugMode):
@@ -66,16 +188,49 @@ def gdbSettings(debugMode):
         gdb.execute('set confirm off')
 
 
+def setupBacktraces(mode):
+    """configure the backtrace capture mode
+
+    - off: no backtraces
+    - pc[:N]: PCs of the innermost N frames, named by the ELF symbols
+    - full: all frames, named by GDB with function and source line
+    """
+    global backtraceDepth
+    if mode == 'off':
+        backtraceDepth = 0
+    elif mode.startswith('pc'):
+        backtraceDepth = int(mode[3:]) if mode.startswith('pc:') else BACKTRACE_DEPTH
+        spModel.stacks.resolve = symbolName
+    else:
+        assert mode == 'full', 'unknown backtrace mode %s' % mode
+        backtraceDepth = None
+        spModel.stacks.resolve = frameName
+
+
+def captureBacktrace(frame):
+    "return the interned stack id of the frames from frame outwards"
+    if backtraceDepth == 0:
+        return None
+    pcs = []
+    while frame is not None and len(pcs) != backtraceDepth:
+        pcs.append(frame.pc())
+        frame = frame.older()
+    return spModel.stacks.intern(tuple(pcs))
+
+
 def installBreakpoints(configFile, userCommand):
     "install breakpoints for synchronization function"
     # read synchronization functions from the config file
     with open(configFile, 'r') as confFile:
-        for fun in confFile:
-            fun = fun.strip()
+        for line in confFile:
+            config = sp_util.parseConfigLine(line)
+            if config is None:
+                continue
+            fun, policy = config
             # Standard configuration function breakpoints are opaque by default.
             # TODO: upgrade the config file to allow opaque specification.
-            SPTraceFunction(fun, opaque=False)
-            log.info('installed breakpoint on %s' % fun)
+            SPTraceFunction(fun, opaque=False, policy=policy)
+            log.info('installed breakpoint on %s %s' % (fun, policy))
     # user-defined commands
     if userCommand != 'None':
         for c in userCommand.split(';'):
@@ -83,32 +238,227 @@ def installBreakpoints(configFile, userCommand):
             log.info('executed user command "%s"' % c)
 
 
+def installFilters(onlyObjects, onlyThreads):
+    """let the breakpoints reject calls on other objects or threads
+
+    GDB runs the Python stop handler before a breakpoint condition, so the
+    handler checks the thread number and the argument registers itself,
+    before it reads anything else. The objects are symbols or addresses,
+    resolved once here.
+    """
+    objects = set(resolveObject(o) for o in onlyObjects or [])
+    for bp in traceFunctions():
+        if objects and OBJECT_FUNCTIONS.match(bp.location):
+            bp.objects = objects
+            bp.objectArgs = 2 if bp.location in SECOND_OBJECT_FUNCTIONS else 1
+        if onlyThreads:
+            bp.threads = set(onlyThreads)
+        if bp.objects is not None or bp.threads is not None:
+            log.info('filtering %s by objects %s and threads %s' % \
+                         (bp.location, bp.objects, bp.threads))
+
+
+def resolveObject(spec):
+    "address of a sync object given by a symbol name or an address"
+    try:
+        return int(spec, 0)
+    except ValueError:
+        pass
+    try:
+        return int(gdb.parse_and_eval('&%s' % spec).cast(gdb.lookup_type('long'))) & \
+            0xffffffffffffffff
+    except gdb.error as e:
+        raise AssertionError('cannot resolve sync object %s: %s' % (spec, e))
+
+
+def detachInferior():
+    "remove all breakpoints, including pending finish breakpoints, and detach"
+    for bp in gdb.breakpoints():
+        bp.delete()
+    spReturns.clear()
+    spWindow.drainInterrupt()
+    gdb.execute('detach')
+    log.info('detached from the program')
+
+
+class SPCaptureWindow(object):
+    """bounds the capture by time and by the number of events
+
+    The capture ends after duration seconds or before the start of event
+    maxEvents+1, whichever comes first. A timer thread interrupts the
+    inferior with SIGINT, which GDB intercepts without passing it on. In
+    non-stop mode, a signal or a breakpoint stops a single thread only, so
+    the window ends with GDB's "interrupt -a" instead, posted to GDB's event
+    loop. An interrupt by the user dumps the flight recorder. With a
+    watchdog timeout, another thread posts the model's watchdog check to GDB's event loop a
+    few times per timeout, so the check runs between breakpoint handlers.
+    """
+    def __init__(self, duration, maxEvents, watchdog=None, nonStop=False):
+        self.duration = duration
+        self.maxEvents = maxEvents
+        self.watchdog = watchdog
+        self.nonStop = nonStop
+        self.events = 0
+        self.pid = None
+        self.timer = None
+        self.watchdogStopped = threading.Event()
+        self.lock = threading.Lock()
+        self.isOpen = False
+        self.interruptSent = False
+        self.interruptSeen = False
+        self.stopping = False
+
+    def open(self):
+        "start the capture"
+        self.pid = gdb.selected_inferior().pid
+        self.isOpen = True
+        if self.duration is not None:
+            self.timer = threading.Timer(self.duration, self.interrupt)
+            self.timer.daemon = True
+            self.timer.start()
+        if self.watchdog is not None:
+            thread = threading.Thread(target=self.watch)
+            thread.daemon = True
+            thread.start()
+        for bp in traceFunctions():
+            bp.startDutyCycle()
+
+    def close(self):
+        "end the capture; no interrupt is sent afterwards"
+        with self.lock:
+            self.isOpen = False
+            if self.timer is not None:
+                self.timer.cancel()
+        self.watchdogStopped.set()
+        for bp in traceFunctions():
+            bp.stopDutyCycle()
+
+    def interrupt(self):
+        "timer thread: stop the inferior at the end of the duration"
+        with self.lock:
+            if self.isOpen and self.pid:
+                log.info('capture window of %s s elapsed' % self.duration)
+                if self.nonStop:
+                    gdb.post_event(self.stopAll)
+                    return
+                self.interruptSent = True
+                os.kill(self.pid, signal.SIGINT)
+
+    def stopAll(self):
+        "non-stop mode, in GDB's thread: stop all threads of the program once"
+        if self.isOpen and not self.stopping and gdb.selected_inferior().pid != 0:
+            self.stopping = True
+            gdb.execute('interrupt -a')
+
+    def watch(self):
+        "watchdog thread: check the progress of the program until the window closes"
+        while not self.watchdogStopped.wait(self.watchdog / 4.0):
+            gdb.post_event(spModel.watchdog)
+
+    def onStop(self, event):
+        "remember that the interrupt has been consumed by GDB"
+        if isinstance(event, gdb.SignalEvent) and event.stop_signal == 'SIGINT':
+            if not self.interruptSent:
+                # Ctrl-C, e.g. in a hang
+                spModel.dump('interrupted')
+            self.interruptSeen = True
+
+    def drainInterrupt(self):
+        """consume an interrupt sent while the window closed for another reason
+
+        Otherwise, the pending SIGINT would be delivered to the detached program.
+        """
+        if self.interruptSent and not self.interruptSeen:
+            gdb.execute('continue')
+
+    def full(self):
+        "True if no more events fit in the window"
+        if self.nonStop and self.pid is not None and not self.isOpen:
+            # the run command returns on the first thread stopping, while the
+            # others may run on into breakpoints until the detach stops them
+            return True
+        if self.maxEvents is None:
+            return False
+        if self.events >= self.maxEvents:
+            log.info('captured %d events' % self.events)
+            if self.nonStop:
+                # the other threads run on; commands cannot run in a stop handler
+                gdb.post_event(self.stopAll)
+            return True
+        self.events += 1
+        return False
+
+
 # TODO: awkward place to print the summary. Perhaps, in spView?
 # To outFile?
 # TODO: use the logger!?
 def printSummary():
-    "print hit counts for each sync point"
+    """print hit counts for each sync point
+
+    Breakpoints with a recording policy report all calls, including those
+    skipped by the policy or while paused, and how many were recorded.
+    """
     print('\nSynchronization point occurences:')
     for bp in gdb.breakpoints():
         # finish breakpoints are not printed
         if type(bp) == SPTraceFunctionFinish:
             continue
-        count = bp.syncHits
+        count = getattr(bp, 'calls', bp.syncHits)
+        recorded = ''
+        if getattr(bp, 'policy', None):
+            recorded = '(%d recorded)' % bp.syncHits
         name = bp.location if bp.type == gdb.BP_BREAKPOINT else bp.expression
         if count > 0:
-            print('{:<30}{:<10}'.format(name, count))
+            print('{:<40}{:<10}{}'.format(name, count, recorded))
+
+
+def traceFunctions():
+    "list of the sync function breakpoints"
+    return [bp for bp in gdb.breakpoints() if isinstance(bp, SPTraceFunction)]
 
 
 class SPTraceFunction(gdb.Breakpoint):
-    "Synchronization function breakpoint sub-class"
-    def __init__(self, spec, opaque=False):
+    """Synchronization function breakpoint sub-class
+
+    The recording policy (see sp_util.parseConfigLine) is enforced first in
+    the stop handler with Python counters, so skipped calls, also while the
+    breakpoint is paused, cost the stop but no frame or register reads. GDB's
+    ignore count does not help, because GDB runs the handler before it.
+    """
+    def __init__(self, spec, opaque=False, policy=None):
         super(SPTraceFunction, self).__init__(spec)
         self.opaque = opaque
-        self.syncHits = 0
+        self.policy = policy or {}
+        self.calls = 0 # all calls, recorded or not
+        self.syncHits = 0 # recorded calls
+        self.skip = 0 # calls to skip before the next recorded one
+        self.paused = False
+        # filters of --only-objects and --only-threads, None traces all
+        self.objects = None
+        self.objectArgs = 1 # number of arguments that may be one of the objects
+        self.threads = None
         self.syncPC = None
+        self.srcLoc = None
+        self.dutyTimer = None
+        self.dutyLock = threading.Lock()
+        if self.policy:
+            spModel.sampled(spec)
 
     def stop (self):
         "report the start of a sync function"
+        timestamp = spClock.enter()
+        try:
+            return self.traceStart(timestamp)
+        finally:
+            spClock.leave()
+
+    def traceStart(self, timestamp):
+        "pass the start of a sync function to the model"
+        if not self.selected():
+            return False
+        self.calls += 1
+        if not self.recorded():
+            return False
         # If PC has changed, we ignore this breakpoint.
         # The reason is that in some code (C++11) pthread_mutex_lock() (and
         # perhaps others) get relocated by the loader and even split into two
@@ -125,25 +475,92 @@ class SPTraceFunction(gdb.Breakpoint):
             log.warning('breakpoint "%s" has multiple PCs: 0x%x and 0x%x' % \
                             (self, self.syncPC, pc))
             return False
+        if spWindow.full():
+            # stop the program to end the capture
+            return True
         self.syncHits += 1
+        if self.syncHits == self.policy.get('max'):
+            log.info('recorded %d calls of %s' % (self.syncHits, self.location))
         thread = gdb.selected_thread().num
-        # TODO: adapt to support ARM
-        arg1 = get('printf "0x%lx", $rdi')
-        arg1 = findSymbol(arg1)
-        arg2 = get('printf "0x%lx", $rsi')
-        arg2 = findSymbol(arg2)
+        frame = gdb.selected_frame()
+        returnSite = spReturns.returnSite(frame)
+        if returnSite is not None:
+            # calls left without returning, e.g. by longjmp, end here
+            spReturns.unwind(thread, returnSite, timestamp)
+        arg1 = findSymbol(readArgument(frame, 0))
+        arg2 = findSymbol(readArgument(frame, 1))
         name = self.location
-        filename, line = findSrcLoc(name)
-        backtrace = get('backtrace')
+        if self.srcLoc is None:
+            self.srcLoc = findSrcLoc(name)
+        filename, line = self.srcLoc
+        backtrace = captureBacktrace(frame)
         event = spModel.startEvent(name, 'function', thread, arg1, arg2, None, filename,
-                                   line, backtrace, self.opaque)
+                                   line, backtrace, self.opaque, pc=pc,
+                                   timestamp=timestamp)
         # event==None means the model skips this event because it happens
         # during another opaque event
         if event is not None:
-            # set a finish breakpoint for this call site
-            SPTraceFunctionFinish(event)
+            if returnSite is not None:
+                spReturns.expect(event, returnSite)
+            else:
+                # the caller is unknown; set a finish breakpoint for this call
+                SPTraceFunctionFinish(event)
         return False
 
+    def selected(self):
+        "False if the call is rejected by the object or thread filters"
+        if self.threads is not None and gdb.selected_thread().num not in self.threads:
+            return False
+        if self.objects is not None:
+            frame = gdb.selected_frame()
+            return any(readArgument(frame, i) in self.objects for i in range(self.objectArgs))
+        return True
+
+    def recorded(self):
+        "apply the recording policy to a call; True if the call is recorded"
+        if self.paused:
+            return False
+        if 'max' in self.policy and self.syncHits >= self.policy['max']:
+            return False
+        if self.skip > 0:
+            self.skip -= 1
+            return False
+        self.skip = self.policy.get('every', 1) - 1
+        return True
+
+    def startDutyCycle(self):
+        "start recording for on ms and pausing for off ms alternately"
+        if 'on' in self.policy:
+            self.scheduleDutyCycle(self.policy['on'], True)
+
+    def stopDutyCycle(self):
+        "stop the duty cycle, keeping the current state"
+        with self.dutyLock:
+            if self.dutyTimer is not None:
+                self.dutyTimer.cancel()
+                self.dutyTimer = None
+
+    def scheduleDutyCycle(self, milliseconds, pause):
+        "pause (or resume) recording after milliseconds"
+        with self.dutyLock:
+            self.dutyTimer = threading.Timer(milliseconds / 1000.0, self.dutyCycle, [pause])
+            self.dutyTimer.daemon = True
+            self.dutyTimer.start()
+
+    def dutyCycle(self, pause):
+        "timer thread: switch the breakpoint in GDB's thread and schedule the next switch"
+        with self.dutyLock:
+            if self.dutyTimer is None:
+                return # stopped
+        gdb.post_event(lambda: self.setPaused(pause))
+        self.scheduleDutyCycle(self.policy['off' if pause else 'on'], not pause)
+
+    def setPaused(self, pause):
+        "skip the calls while paused, still counting them"
+        if self.is_valid() and self.dutyTimer is not None:
+            log.debug('%s %s' % ('pausing' if pause else 'resuming', self.location))
+            self.paused = pause
+
 
 class SPTraceFunctionFinish(gdb.FinishBreakpoint):
     "Finish breakpoint for synchronization functions"
@@ -155,32 +572,163 @@ class SPTraceFunctionFinish(gdb.FinishBreakpoint):
         log.debug('new finish breakpoint %s for event %s' % (self, event.toString()))
     def stop(self):
         "report the end of the parent breakpoint"
-        # set new thread ID in the clone event for the model
-        if self.parent.evName == 'clone':
-            self.__setNewThread(self.parent)
-        spModel.stopEvent(self.parent)
+        timestamp = spClock.enter()
+        try:
+            finishEvent(self.parent, timestamp)
+        finally:
+            spClock.leave()
         return False
-    def __setNewThread(self, event):
-        "set newThread to specify parent-child thread relationship"
-        osThreadId = get('printf "%d", $rax') # aka LWP
-        # TODO: more elegant solution. If called only once
-        # I get a [New thread...] message first. Perhaps, I have to
-        # disable progress in other threads with "set scheduler..."?
-        findResult = get('thread find (LWP %s)' % osThreadId)
-        findResult = get('thread find (LWP %s)' % osThreadId)
-        assert not findResult.startswith('No threads match'), \
-            'Could not determine new thread ID'
-        # gdb> thread find (LWP 2134)
-        # Thread 2 has target id 'Thread 0x7ffff77fd700 (LWP 2134)'
-        findResult = findResult.split()
-        event.evNewThread = {'gdb': int(findResult[1]),
-                             'pthread_t': findResult[6]}
     def out_of_scope(self):
         "envoked when GDB can not hit the finish breakpoint"
         log.warning('breakpoint %s out of scope' % self)
         # self.stop() # did not work for whatever reason
 
 
+class SPReturnProbe(gdb.Breakpoint):
+    "persistent breakpoint on a return address, shared by all calls returning there"
+    def __init__(self, address):
+        super(SPReturnProbe, self).__init__('*0x%x' % address, internal=True)
+        self.address = address
+    def stop(self):
+        "report the return of a pending call"
+        timestamp = spClock.enter()
+        try:
+            spReturns.returned(self.address, timestamp)
+        finally:
+            spClock.leave()
+        return False
+
+
+class SPReturnProbes(object):
+    """matches returns to the pending calls of the sync functions
+
+    Instead of a finish breakpoint per call, there is one persistent return
+    probe per distinct return address. It stays enabled once created, so hot
+    calls do not insert and remove it each time; hits without a pending call,
+    e.g. of calls skipped by a policy, are ignored. A return is matched to a pending call by the thread and the
+    stack pointer of the caller. Pending calls whose caller frame is gone
+    (longjmp, thread or program exit) are aborted in the model.
+    """
+    def __init__(self):
+        self.probes = {} # return address -> SPReturnProbe
+        self.pending = {} # thread -> list of (return address, caller SP, event)
+
+    def returnSite(self, frame):
+        "(return address, caller SP) of the function stopped in frame, or None"
+        caller = frame.older()
+        if caller is None:
+            return None
+        return caller.pc(), readRegister(caller, 'sp')
+
+    def expect(self, event, returnSite):
+        "wait for the return of the call of event"
+        address, sp = returnSite
+        if address not in self.probes:
+            self.probes[address] = SPReturnProbe(address)
+        self.pending.setdefault(event.evThread, []).append((address, sp, event))
+
+    def returned(self, address, timestamp):
+        "a probe at address was hit; finish the matching pending call"
+        thread = gdb.selected_thread().num
+        pending = self.pending.get(thread)
+        if not pending:
+            return # a call that was not recorded
+        sp = readRegister(gdb.selected_frame(), 'sp')
+        for i in range(len(pending) - 1, -1, -1):
+            if pending[i][0] == address and pending[i][1] == sp:
+                break
+        else:
+            return # a call that was not recorded
+        # calls deeper in the stack were left without returning
+        self.abort(thread, len(pending) - i - 1, timestamp)
+        # a sync function tail-calling another one returns for both
+        while pending and pending[-1][:2] == (address, sp):
+            _address, _sp, event = self.pop(thread)
+            finishEvent(event, timestamp)
+
+    def unwind(self, thread, returnSite, timestamp):
+        """abort pending calls of thread whose caller frame is gone
+
+        These are the calls deeper in the stack than the new call's caller, or
+        level with it, unless the new call is a tail call from the pending one.
+        """
+        address, sp = returnSite
+        pending = self.pending.get(thread, [])
+        count = 0
+        while count < len(pending) and \
+                (pending[-1 - count][1] < sp or \
+                     pending[-1 - count][1] == sp and pending[-1 - count][0] != address):
+            count += 1
+        self.abort(thread, count, timestamp)
+
+    def abort(self, thread, count, timestamp):
+        "abort the count innermost pending calls of thread"
+        for _i in range(count):
+            _address, _sp, event = self.pop(thread)
+            log.info('call %s did not return' % event.toString())
+            spModel.abortEvent(event, timestamp)
+
+    def pop(self, thread):
+        "remove the innermost pending call of thread"
+        return self.pending[thread].pop()
+
+    def onThreadExited(self, event):
+        "abort the pending calls of an exited thread"
+        thread = event.inferior_thread.num
+        self.abort(thread, len(self.pending.get(thread, [])), spClock.enter())
+        spClock.leave()
+
+    def onExited(self, event):
+        "abort all pending calls when the program exits, e.g. in exit()"
+        timestamp = spClock.enter()
+        for thread in self.pending:
+            self.abort(thread, len(self.pending[thread]), timestamp)
+        spClock.leave()
+
+    def clear(self):
+        "delete all probes, keeping pending calls to the model's shutdown"
+        for probe in self.probes.values():
+            if probe.is_valid():
+                probe.delete()
+        self.probes = {}
+        self.pending = {}
+
+
+def finishEvent(event, timestamp):
+    "pass the return of a sync function and its return value to the model"
+    event.evValue = readReturnValue(gdb.selected_frame())
+    # set new thread ID in the clone event for the model
+    if event.evName == 'clone':
+        setNewThread(event)
+    spModel.stopEvent(event, timestamp)
+
+
+def setNewThread(event):
+    "set newThread to specify parent-child thread relationship"
+    osThreadId = readReturnValue(gdb.selected_frame()) # aka LWP
+    for thread in gdb.selected_inferior().threads():
+        if thread.ptid[1] == osThreadId and hasattr(thread, 'handle'):
+            # the thread handle holds the pthread_t in native byte order
+            pthread = struct.unpack('=Q', thread.handle()[:8])[0]
+            event.evNewThread = {'gdb': thread.num,
+                                 'pthread_t': '0x%x' % pthread}
+            return
+    # GDB older than 8.3 has no thread handles, or GDB has not yet noticed
+    # the new thread. Then fall back to the thread find command.
+    # TODO: more elegant solution. If called only once
+    # I get a [New thread...] message first. Perhaps, I have to
+    # disable progress in other threads with "set scheduler..."?
+    findResult = get('thread find (LWP %s)' % osThreadId)
+    findResult = get('thread find (LWP %s)' % osThreadId)
+    assert not findResult.startswith('No threads match'), \
+        'Could not determine new thread ID'
+    # gdb> thread find (LWP 2134)
+    # Thread 2 has target id 'Thread 0x7ffff77fd700 (LWP 2134)'
+    findResult = findResult.split()
+    event.evNewThread = {'gdb': int(findResult[1]),
+                         'pthread_t': findResult[6]}
+
+
 class SPTraceAccess(gdb.Breakpoint):
     "Watchpoint for accesses to user-defined locations"
     def __init__(self, accessSpec):
@@ -195,6 +743,15 @@ class SPTraceAccess(gdb.Breakpoint):
 
     def stop (self):
         "report the access"
+        timestamp = spClock.enter()
+        try:
+            self.traceAccess(timestamp)
+        finally:
+            spClock.leave()
+        return False
+
+    def traceAccess(self, timestamp):
+        "pass the access to the model"
         # TODO: find out read/write and value using: Symbol.value()
         self.syncHits += 1
         value = str(gdb.selected_frame().read_var(self.expression))
@@ -202,17 +759,67 @@ class SPTraceAccess(gdb.Breakpoint):
         self.syncName = 'ACCESS %s' % self.expression
         # TODO: find out the current source location and line
         filename = line = '?'
-        backtrace = get('backtrace')
-        event = spModel.startEvent(self.syncName,
-                                   'access',
-                                   self.syncThread,
-                                   None,
-                                   value,
-                                   filename,
-                                   line,
-                                   backtrace,
-                                   False)
-        return False
+        backtrace = captureBacktrace(gdb.selected_frame())
+        spModel.startEvent(self.syncName,
+                           'access',
+                           self.syncThread,
+                           None,
+                           None,
+                           value,
+                           filename,
+                           line,
+                           backtrace,
+                           False,
+                           timestamp=timestamp)
+
+
+def frameAbi(frame):
+    "calling convention registers for the architecture of frame"
+    global abi
+    if abi is None:
+        arch = frame.architecture().name()
+        assert arch in ABI, 'unsupported architecture %s' % arch
+        abi = ABI[arch]
+    return abi
+
+
+def readRegister(frame, register):
+    "unsigned integer value of register in frame"
+    return int(frame.read_register(register)) & 0xffffffffffffffff
+
+
+def readArgument(frame, index):
+    "integer argument number index (from 0) of the function stopped in frame"
+    return readRegister(frame, frameAbi(frame)['args'][index])
+
+
+def readReturnValue(frame):
+    "integer return value of the function that has just returned to frame"
+    return readRegister(frame, frameAbi(frame)['ret'])
+
+
+def symbolName(pc):
+    "name of the ELF symbol containing pc"
+    name = spSymbolizer.symbol(pc)
+    return name if name is not None else '0x%x' % pc
+
+
+def frameName(pc):
+    "function name and source line of pc as in GDB's backtrace"
+    try:
+        block = gdb.block_for_pc(pc)
+    except RuntimeError:
+        block = None
+    # no block covers frames without debug info, e.g. in libc; the innermost
+    # block may be a lexical block inside the function
+    while block is not None and block.function is None:
+        block = block.superblock
+    function = block.function if block is not None else None
+    name = function.name if function is not None else symbolName(pc)
+    sal = gdb.find_pc_line(pc)
+    if sal.symtab is not None:
+        name += ' at %s:%d' % (sal.symtab.filename, sal.line)
+    return name
 
 
 def findSrcLoc(location):
@@ -227,14 +834,47 @@ def findSrcLoc(location):
     return filename, line
 
 
-# TODO: rewrite using Python API
+def snapshotMaps(event=None):
+    "pass the memory map of the running inferior to the symbolizer"
+    pid = gdb.selected_inferior().pid
+    if pid == 0:
+        return
+    if spWindow is not None:
+        # the pid changes when GDB restarts the program
+        spWindow.pid = pid
+    maps = sp_symbols.readMaps(pid)
+    if spSymbolizer is None:
+        spModel.addMaps(maps)
+    else:
+        spSymbolizer.addMaps(maps)
+
+
+# symbols of addresses resolved by GDB so far
+symbolCache = {}
+
+
 def findSymbol(address):
-    "find the symbol associated with address"
+    """find the symbol associated with the integer address
+
+    In the raw capture mode the address is kept for bulk symbolization at
+    replay. Otherwise, the ELF symbol tables are tried before asking GDB, and
+    each distinct address is resolved only once.
+    """
+    if spSymbolizer is None:
+        return address
+    symbol = spSymbolizer.symbol(address)
+    if symbol is not None:
+        return symbol
+    if address in symbolCache:
+        return symbolCache[address]
+    address = '0x%x' % address
     gdbStr  = get('info symbol ' + address)
     if gdbStr.startswith('No symbol matches '):
-        return address
+        symbol = address
     else:
-        return gdbStr.split()[0]
+        symbol = gdbStr.split()[0]
+    symbolCache[int(address, 16)] = symbol
+    return symbol
 
 
 # TODO: via Python API?
@@ -263,6 +903,9 @@ except Exception as e:
     log.error('sync-prof encountered an unexpected exception:')
     import traceback
     traceback.print_exc()
+    # keep the events collected so far
+    if spModel is not None:
+        spModel.close()
     if debugMode:
         import pdb
         pdb.post_mortem()
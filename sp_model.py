@@ -1,28 +1,43 @@
 # sync-prof's model of synchronization events and their relations
 
 
+import atexit
+import collections
 import sys
+import sp_analysis
 import sp_view
-from sp_util import SPStack
+from sp_util import BLOCKING_LOCKS, LOCK_FUNCTIONS, SPStack, SPStackTable, clock, \
+    internString, lockFailed, returnedTrue
 
 
 # TODO: remove silly .ev prefixes
 class SPSyncEvent(object):
-    "captures a single synchronization event"
+    """captures a single synchronization event
+
+    Events are numerous, so they have slots instead of a dictionary, and
+    their strings are interned to share the copies of repeated names.
+    """
+    __slots__ = ['evName', 'evType', 'evThread', 'evArg1', 'evArg2', 'evValue',
+                 'evFilename', 'evLine', 'evBacktrace', 'evOpaque', 'evPC', 'status',
+                 'signaled', 'evNewThread', 'startTime', 'stopTime']
     def __init__(self, evName, evType, evThread, evArg1, evArg2, evValue, evFilename,
-                 evLine, evBacktrace, evOpaque):
-        self.evName = evName
+                 evLine, evBacktrace, evOpaque, evPC=None):
+        self.evName = internString(evName)
         self.evType = evType # function or access
         self.evThread = evThread
-        self.evArg1 = evArg1
-        self.evArg2 = evArg2
+        self.evArg1 = internString(evArg1)
+        self.evArg2 = internString(evArg2)
         self.evValue = evValue
-        self.evFilename = evFilename
+        self.evFilename = internString(evFilename)
         self.evLine = evLine
-        self.evBacktrace = evBacktrace
+        self.evBacktrace = evBacktrace # stack id in the model's stack table
         self.evOpaque = evOpaque # opaque events do not trace internally
+        self.evPC = evPC
         self.status = 'started'
+        self.signaled = False # only for waits: a post or signal is linked to it
         self.evNewThread = None # only for clone()
+        self.startTime = None
+        self.stopTime = None
     def __str__(self):
         return '%s %s' % (self.evName, self.evArg1)
     def toString(self):
@@ -30,31 +45,198 @@ class SPSyncEvent(object):
             (self.evName, self.evArg1, self.evThread, self.startTime, self.status)
 
 
+class SPSignalQueue(object):
+    """FIFO of posts per sync object, waiting to be paired with future waits
+
+    The queues are bounded: at most capacity posts per object, and posts
+    older than maxAge model events are dropped. The dropped posts are
+    counted, so they can be reported.
+    """
+    def __init__(self, capacity=1024, maxAge=100000):
+        self.capacity = capacity
+        self.maxAge = maxAge
+        self.queues = {} # object -> deque of (event number, event)
+        self.overflowed = 0
+        self.agedOut = 0
+        self.puts = 0
+
+    def put(self, obj, event, now):
+        "queue a post of obj at event number now"
+        queue = self.queues.setdefault(obj, collections.deque())
+        if len(queue) >= self.capacity:
+            queue.popleft()
+            self.overflowed += 1
+        queue.append((now, event))
+        self.puts += 1
+        if self.puts % self.capacity == 0:
+            # objects that are not waited for any more keep memory flat too
+            self.ageOut(now)
+
+    def get(self, obj, now):
+        "dequeue the oldest post of obj, or None"
+        queue = self.queues.get(obj)
+        if queue is None:
+            return None
+        self.ageOutQueue(obj, queue, now)
+        event = queue.popleft()[1] if queue else None
+        if not queue:
+            del self.queues[obj]
+        return event
+
+    def ageOut(self, now):
+        "drop the posts older than maxAge of all objects"
+        for obj, queue in list(self.queues.items()):
+            self.ageOutQueue(obj, queue, now)
+            if not queue:
+                del self.queues[obj]
+
+    def ageOutQueue(self, obj, queue, now):
+        "drop the posts older than maxAge of obj"
+        while queue and now - queue[0][0] > self.maxAge:
+            queue.popleft()
+            self.agedOut += 1
+
+    def pending(self):
+        "number of queued posts"
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class SPOmpRegion(object):
+    "OpenMP parallel region with the chunks and barrier waits of its team"
+    __slots__ = ['number', 'master', 'startTime', 'threads']
+    def __init__(self, number, master, startTime):
+        self.number = number
+        self.master = master
+        self.startTime = startTime
+        # threads calling the OpenMP runtime -> [loop chunks, barrier wait]
+        self.threads = {master: [0, 0]}
+
+
 class SPModel(object):
-    "list of breakpoint stacks pending completion per thread"
-    def __init__(self, outFormat, outFile, log):
+    """list of breakpoint stacks pending completion per thread
+
+    Without timing, the model time is a logical clock advancing by timeDelta
+    per event. With timing, the model time is in microseconds since the first
+    event, derived from the timestamps (in seconds) passed by the collector.
+    The model time never goes backwards and still advances by timeDelta per
+    event to keep the order of events with equal timestamps.
+
+    The analyses named in analyses observe the events besides the view. Their
+    reports are printed at the end and saved to reportFile if given. The
+    summary format without analyses needs no annotations, so the model then
+    skips the hidden events, links and groups, and keeps no lock stacks or
+    OpenMP regions.
+
+    The flight format keeps only the last events. flightRecorder is a dict of
+    the number of 'events' kept, the 'watchdog' timeout in seconds and the
+    'triggers', i.e. functions whose calls dump the recorder. The recorder
+    is also dumped by dump(), e.g. on an interrupt, and at the end of the run
+    if it was not dumped before.
+    """
+    def __init__(self, outFormat, outFile, log, timing=False, analyses=None,
+                 reportFile=None, flightRecorder=None):
         # TODO: document this key structure
         self.pendEventDict = {}
+        # indexes of pending events by (evName, evArg1) for the link matching,
+        # each an OrderedDict of events in the order they were indexed
+        self.waitIndex = {} # events not woken by a post or signal yet
+        self.topEventIndex = {} # events on the top of their thread's stack
+        self.pthreads = {} # pthread_t -> thread
         self.time = 0
-        self.semPosts = {}
-        self.condvarSignals = {}
+        self.numEvents = 0
+        # unmatched semaphore posts; unmatched condition signals are lost
+        self.semPosts = SPSignalQueue()
+        self.wastedSignals = 0
         self.timeDelta = 1 # synchronization time step
+        self.timing = timing
+        self.timeOrigin = None # timestamp of the first event
         self.condWaits = ['pthread_cond_wait', 'pthread_cond_timedwait']
-        self.View = sp_view.sp_view(outFile, outFormat)
+        # OpenMP functions ending with a team barrier
+        self.ompBarriers = ['GOMP_barrier', 'GOMP_barrier_cancel', 'GOMP_loop_end',
+                            'GOMP_loop_end_cancel', 'GOMP_sections_end',
+                            'GOMP_sections_end_cancel', 'GOMP_parallel_end']
+        self.ompRegions = [] # parallel regions being executed, innermost last
+        self.numOmpRegions = 0
+        # functions not recorded on every call, so their pairs may be missing
+        self.sampledFunctions = set()
+        self.stacks = SPStackTable()
+        flightRecorder = flightRecorder or {}
+        self.recorder = None
+        self.triggers = set(flightRecorder.get('triggers') or [])
+        self.watchdogTimeout = flightRecorder.get('watchdog')
+        self.watchdogEvents = None # number of events at the last watchdog check
+        self.watchdogTime = None
+        if outFormat == 'flight':
+            self.recorder = sp_view.SPViewFlight(outFile, timing, self.stacks,
+                                                 flightRecorder.get('events') or
+                                                 sp_view.FLIGHT_EVENTS)
+            self.View = self.recorder
+        else:
+            self.View = sp_view.sp_view(outFile, outFormat, timing, self.stacks)
+        self.analyses = sp_analysis.analyses(analyses or [], self.stacks, timing)
+        if self.analyses:
+            self.View = sp_view.SPViewTee([self.View] + self.analyses)
+        self.annotate = outFormat != 'summary' or bool(self.analyses)
+        self.reportFile = reportFile
         self.log = log
+        self.closed = False
+        # finish the pending events and close the view even if the collector
+        # shuts down abruptly
+        atexit.register(self.close)
 
     def __del__(self):
-        self.flushPendEvents()
-        del self.View
+        self.close()
+
+    def close(self):
+        "finish pending events and close the view; safe to call more than once"
+        if not self.closed:
+            self.closed = True
+            self.dump('end of the run', final=True)
+            self.flushPendEvents()
+            self.reportSignals()
+            self.View.close()
+            self.report()
+
+    def dump(self, reason, final=False):
+        """dump the flight recorder with the reason; if final, only if it was
+        not dumped before"""
+        if self.recorder is None or (final and self.recorder.dumps > 0):
+            return
+        if self.recorder.dump(reason, self.pendEventDict, self.time):
+            self.log.warning('flight recorder dumped to %s: %s' % \
+                                 (self.recorder.outFileName, reason))
+
+    def watchdog(self):
+        "dump the flight recorder after no events for the watchdog timeout; call periodically"
+        if self.recorder is None or self.watchdogTimeout is None:
+            return
+        now = clock()
+        if self.numEvents != self.watchdogEvents:
+            self.watchdogEvents = self.numEvents
+            self.watchdogTime = now
+        elif now - self.watchdogTime >= self.watchdogTimeout:
+            self.dump('no events for %g s' % self.watchdogTimeout)
+
+    def report(self):
+        "print the reports of the analyses and save them to the report file"
+        if not self.analyses:
+            return
+        reports = sp_analysis.reports(self.analyses)
+        sp_analysis.printReport(reports, sys.stdout)
+        if self.reportFile is not None:
+            sp_analysis.writeReport(reports, self.reportFile)
 
     def startEvent(self, evName, evType, evThread, evArg1, evArg2, evValue, evFilename,
-                   evLine, evBacktrace, evOpaque, generatedEvent=False):
+                   evLine, evBacktrace, evOpaque, pc=None, timestamp=None,
+                   generatedEvent=False):
         # TODO: proper implementation for non-nested functions to support complex
         # unstructured control flow with goto, longjmp().
         if not generatedEvent and self.threadOpaque(evThread):
             return None
+        self.advanceTime(timestamp)
+        self.numEvents += 1
         event = SPSyncEvent(evName, evType, evThread, evArg1, evArg2, evValue, evFilename,
-                            evLine, evBacktrace, evOpaque)
+                            evLine, evBacktrace, evOpaque, pc)
         # TODO: hack to avoid crashing on nested breakpoints with the same argument
         # This case needs a better solution. For now, we ignore an event if its
         event.startTime = self.time
@@ -66,36 +248,66 @@ class SPModel(object):
             'thread %d not in self.pendEventDict %s' % \
             (event.evThread, self.pendEventDict)
         evList = self.pendEventDict[event.evThread]['events']
+        if not evList.empty():
+            self.unindex(self.topEventIndex, evList.top())
         evList.push(event)
+        self.index(self.waitIndex, event)
+        self.index(self.topEventIndex, event)
         # TODO: assert no duplicates in the all pendEvents lists
         # TODO: more abstract datastruct to ensure the view does not corrupt it
-        self.View.timestamp(self.pendEventDict)
-        self.generateEvent(event)
+        self.View.timestamp(self.pendEventDict, event)
+        if event.evName in self.triggers:
+            self.dump('%s called in thread %s' % (event.evName, event.evThread))
+        if self.annotate:
+            self.generateEvent(event)
         if event.evType == 'access':
             # remove right away, because it is an atomic event
             self.stopEvent(event)
         else:
             event.status = 'waiting'
-        # view annotations besides the timestamps
-        self.links(event)
+        if self.annotate:
+            # view annotations besides the timestamps
+            self.links(event)
+            self.parallelRegions(event)
         return event # TODO: weird that controller wants it
 
 
-    def stopEvent(self, event):
+    def stopEvent(self, event, timestamp=None):
         "stop the event and remove it from the waiting stack"
         self.log.debug('stopEvent: event=%s' % event.toString())
         assert event.status != 'finished', 'Event %s must not be finished' % event
+        self.advanceTime(timestamp)
         event.status = 'finished'
         event.stopTime = self.time
-        self.generateEvent(event)
+        if self.annotate:
+            self.generateEvent(event)
         self.time += self.timeDelta
-        self.View.timestamp(self.pendEventDict)
-        # view annotations besides the timestamps
-        self.linkThreads(event)
-        self.lockBlocks(event)
+        self.View.timestamp(self.pendEventDict, event)
+        if self.annotate:
+            # view annotations besides the timestamps
+            self.linkThreads(event)
+            self.lockBlocks(event)
+            self.parallelRegions(event)
         self.__dropEvent(event)
 
 
+    def sampled(self, evName):
+        "declare that not every call of evName is recorded"
+        self.sampledFunctions.add(evName)
+
+    def isSampled(self, evNames):
+        "True if any of evNames is sampled"
+        return not self.sampledFunctions.isdisjoint(evNames)
+
+    def advanceTime(self, timestamp):
+        "move the model time to a native timestamp in seconds"
+        if not self.timing or timestamp is None:
+            return
+        if self.timeOrigin is None:
+            self.timeOrigin = timestamp
+        time = int((timestamp - self.timeOrigin) * 1e6)
+        self.time = max(self.time, time)
+
     def __dropEvent(self, event):
         "remove the event from the waiting stack"
         threadEvents = self.pendEventDict[event.evThread]['events']
@@ -104,8 +316,49 @@ class SPModel(object):
             'Event %s must be the last element of threadEvents %s' % \
             (event, [str(e) for e in threadEvents])
         threadEvents.pop()
+        if not event.signaled:
+            self.unindex(self.waitIndex, event)
+        self.unindex(self.topEventIndex, event)
+        if not threadEvents.empty():
+            self.index(self.topEventIndex, threadEvents.top())
 
-    def abortEvent(self, event):
+    def index(self, eventIndex, event):
+        "add event to eventIndex"
+        eventIndex.setdefault((event.evName, event.evArg1), collections.OrderedDict())[event] = None
+
+    def unindex(self, eventIndex, event):
+        "remove event from eventIndex"
+        key = (event.evName, event.evArg1)
+        events = eventIndex[key]
+        del events[event]
+        if not events:
+            del eventIndex[key]
+
+    def pendEvents(self, eventIndex, evNames, evArg1):
+        "pending events in eventIndex with a name in evNames and the first argument evArg1"
+        events = []
+        for evName in evNames:
+            events += eventIndex.get((evName, evArg1), {})
+        return events
+
+    def oldestEvent(self, eventIndex, evNames, evArg1):
+        "the earliest started event of pendEvents(eventIndex, evNames, evArg1), or None"
+        oldest = None
+        for evName in evNames:
+            events = eventIndex.get((evName, evArg1))
+            if events:
+                # events are indexed when they start, so the first one is the oldest
+                event = next(iter(events))
+                if oldest is None or event.startTime < oldest.startTime:
+                    oldest = event
+        return oldest
+
+    def wake(self, event):
+        "mark a wait as woken by a post or signal"
+        event.signaled = True
+        self.unindex(self.waitIndex, event)
+
+    def abortEvent(self, event, timestamp=None):
         "abort the unfinished event and remove it from the waiting stack"
         self.log.info('abortEvent: event=%s' % event)
         # TODO: more robust implementation:
@@ -113,10 +366,12 @@ class SPModel(object):
         # point marked as finished, when SIGINT is caught by sync-prof. Hence, we
         # need a nice & graceful shutdown mechanism.
         assert event.status != 'aborted', 'Event %s must not be aborted' % event
+        self.advanceTime(timestamp)
         event.status = 'aborted'
         event.stopTime = self.time
-        self.generateEvent(event)
-        self.View.timestamp(self.pendEventDict)
+        if self.annotate:
+            self.generateEvent(event)
+        self.View.timestamp(self.pendEventDict, event)
         self.__dropEvent(event)
         # Aborted events did not finish, e.g. due to a deadlock.
         # Hence, such events do not trigger extra view annotations.
@@ -128,14 +383,15 @@ class SPModel(object):
         semToEvNames = ['sem_wait']
         condvarSrcEvNames = ['pthread_cond_broadcast', 'pthread_cond_signal']
         condvarToEvNames = self.condWaits
-        mutexDescr = {'name': 'lock released',
-                      'pendEv': ['pthread_mutex_lock'],
-                      'argName': 'lock'}
         barrierDescr = {'name': 'barrier reached',
                         'pendEv': ['pthread_barrier_wait'],
                         'argName': 'barrier'}
-        pendEventLinkDescs = {'pthread_mutex_unlock': mutexDescr,
-                              'pthread_barrier_wait': barrierDescr}
+        pendEventLinkDescs = {'pthread_barrier_wait': barrierDescr}
+        # mutexes, reader/writer locks and spinlocks
+        for unlockName, lockNames in BLOCKING_LOCKS.items():
+            pendEventLinkDescs[unlockName] = {'name': 'lock released',
+                                              'pendEv': lockNames,
+                                              'argName': 'lock'}
         if event.evName in semSrcEvNames + semToEvNames:
             # semaphores
             self.__link(event,
@@ -151,7 +407,7 @@ class SPModel(object):
                         'condition variable',
                         condvarSrcEvNames,
                         condvarToEvNames,
-                        self.condvarSignals)
+                        None)
         elif event.evName in pendEventLinkDescs:
             self.__pendEventsLink(event, pendEventLinkDescs[event.evName])
 
@@ -161,6 +417,8 @@ class SPModel(object):
             newThreadId = event.evNewThread['gdb']
             self.addThreadIfNeeded(newThreadId)
             self.pendEventDict[newThreadId]['pthread_t'] = event.evNewThread['pthread_t']
+            # a pthread_t may be reused after the thread was joined
+            self.pthreads[event.evNewThread['pthread_t']] = newThreadId
             self.View.link('synchronization flow',
                            'thread started',
                            event.startTime,
@@ -170,11 +428,12 @@ class SPModel(object):
                            event.evNewThread)
             # TODO: self.View.mark('thread start'...)?
         elif event.evName == 'pthread_join' and event.status == 'finished':
-            # find thread that finished
-            threads = [t for t in self.pendEventDict \
-                           if self.pendEventDict[t]['pthread_t'] == event.evArg1]
-            assert len(threads) == 1, 'Cannot find thread %s to join' % event.evArg1
-            thread = threads[0]
+            # find thread that finished; its creation may not have been
+            # recorded, e.g. before an attach or by a filter or policy
+            if event.evArg1 not in self.pthreads:
+                self.log.warning('cannot find thread %s to join' % event.evArg1)
+                return
+            thread = self.pthreads[event.evArg1]
             self.View.link('synchronization flow',
                            'thread finished',
                            event.stopTime - self.timeDelta,
@@ -192,34 +451,45 @@ class SPModel(object):
                                           'locks': SPStack(),
                                           'pthread_t': None}
 
-    def __link(self, event, name, arg, srcEvNames, toEvNames, srcEvents):
-        "generate links in the view"
+    def __link(self, event, name, arg, srcEvNames, toEvNames, srcQueue):
+        """generate links in the view
+
+        A post or signal wakes the oldest waiting destination event not woken
+        yet; a broadcast wakes all of them. Without a waiting destination, a
+        post is queued in srcQueue for the next wait, while a condition
+        signal (srcQueue None) is lost.
+        """
         if event.evName in srcEvNames:
-            # TODO: FIFO required for each semaphore to support sequencies like:
-            #       sem_post, sem_post, sem_wait, sem_wait.
-            # sem_wait in progress?
-            waitFound = False
-            for threadDict in self.pendEventDict.values():
-                eventStack = threadDict['events']
-                for e in eventStack:
-                    if e.evName in toEvNames and e.evArg1 == event.evArg1:
-                        waitFound = True # TODO: more elegant code?
-                        # indicate (potential) sync flow to the destination
-                        extraArgs = {arg: e.evArg1}
-                        self.View.link('synchronization flow',
-                                       name,
-                                       event.startTime,
-                                       event.evThread,
-                                       self.time, # after increment
-                                       e.evThread,
-                                       extraArgs)
-            if not waitFound:
-                # no waiting destination event, so just remember for future
-                srcEvents[event.evArg1] = event
+            if event.evName == 'pthread_cond_broadcast':
+                waits = self.pendEvents(self.waitIndex, toEvNames, event.evArg1)
+                waits.sort(key=lambda e: e.startTime)
+            else:
+                oldest = self.oldestEvent(self.waitIndex, toEvNames, event.evArg1)
+                waits = [oldest] if oldest is not None else []
+            for e in waits:
+                self.wake(e)
+                # indicate (potential) sync flow to the destination
+                extraArgs = {arg: e.evArg1}
+                self.View.link('synchronization flow',
+                               name,
+                               event.startTime,
+                               event.evThread,
+                               self.time, # after increment
+                               e.evThread,
+                               extraArgs)
+            if not waits:
+                if srcQueue is None:
+                    self.wastedSignals += 1
+                elif not self.isSampled(toEvNames):
+                    # no waiting destination event, so just remember for future.
+                    # With sampled destinations, the recorded destination may
+                    # belong to another source.
+                    srcQueue.put(event.evArg1, event, self.numEvents)
         # link to destination events
         elif event.evName in toEvNames:
-            if event.evArg1 in srcEvents:
-                fromEvent = srcEvents[event.evArg1]
+            fromEvent = None if srcQueue is None else srcQueue.get(event.evArg1, self.numEvents)
+            if fromEvent is not None:
+                self.wake(event)
                 # link the source event with destination event in the view
                 extraArgs = {arg: event.evArg1}
                 self.View.link('synchronization flow',
@@ -229,37 +499,68 @@ class SPModel(object):
                                event.startTime,
                                event.evThread,
                                extraArgs)
-                srcEvents.pop(event.evArg1, None)
+
+    def reportSignals(self):
+        "report posts never paired with a wait and signals without waiters"
+        queue = self.semPosts
+        for count, what in [(queue.overflowed, 'semaphore posts dropped from full queues'),
+                            (queue.agedOut, 'semaphore posts aged out of the queues'),
+                            (queue.pending(), 'semaphore posts without a wait'),
+                            (self.wastedSignals, 'condition signals without a waiter')]:
+            if count > 0:
+                self.log.info('%d %s' % (count, what))
+        dropped = queue.overflowed + queue.agedOut
+        if dropped > 0:
+            self.log.warning('%d semaphore posts were not paired with waits' % dropped)
+            self.View.mark('%d semaphore posts dropped' % dropped, 'WARNING', 'global',
+                           self.time, 1)
 
     def __pendEventsLink(self, event, linkDescr):
         "link pending events, such as barriers and locks"
         # TODO: review and revise (written too hastily), add asserts
-        for threadDict in self.pendEventDict.values():
-            eventStack = threadDict['events']
-            if not eventStack.empty():
-                pendEvent = eventStack.top()
-                if event != pendEvent and \
-                        pendEvent.evName in linkDescr['pendEv'] and \
-                        event.evArg1 == pendEvent.evArg1:
-                    extraArgs = {linkDescr['argName']: event.evArg1}
-                    # TODO: rethink when native timing is added
-                    stopTime = event.startTime + self.timeDelta
-                    self.View.link('synchronization flow',
-                                   linkDescr['name'],
-                                   event.startTime,
-                                   event.evThread,
-                                   stopTime,
-                                   pendEvent.evThread,
-                                   extraArgs)
+        for pendEvent in self.pendEvents(self.topEventIndex, linkDescr['pendEv'], event.evArg1):
+            if event != pendEvent:
+                extraArgs = {linkDescr['argName']: event.evArg1}
+                # TODO: rethink when native timing is added
+                stopTime = event.startTime + self.timeDelta
+                self.View.link('synchronization flow',
+                               linkDescr['name'],
+                               event.startTime,
+                               event.evThread,
+                               stopTime,
+                               pendEvent.evThread,
+                               extraArgs)
 
     def lockBlocks(self, event):
-        "find lock-unlock pairs and emit lock blocks in the view"
+        """find lock-unlock pairs and emit lock blocks in the view
+
+        Mutex unlocks must match the innermost mutex lock of the thread.
+        Reader/writer locks and spinlocks are matched by their argument, as
+        they are often released in another order. Failed trylocks and timed
+        out locks hold nothing.
+        """
+        locks = self.pendEventDict[event.evThread]['locks']
+        sampled = self.isSampled(BLOCKING_LOCKS) or self.isSampled(LOCK_FUNCTIONS)
         # push locks to stacks per thread
-        if event.evName in ['pthread_mutex_lock', 'pthread_mutex_trylock']:
-            self.pendEventDict[event.evThread]['locks'].push(event)
+        if event.evName in LOCK_FUNCTIONS:
+            if lockFailed(event):
+                return
+            if sampled:
+                # the unlock of an earlier lock of the same lock was not recorded
+                locks.remove(lambda lock: lock.evArg1 == event.evArg1)
+            locks.push(event)
         # unlocks triggers lock blocks in view
-        elif event.evName == 'pthread_mutex_unlock':
-            lastLock = self.pendEventDict[event.evThread]['locks'].pop()
+        elif event.evName in BLOCKING_LOCKS:
+            unlockOf = lambda lock: LOCK_FUNCTIONS[lock.evName][0] == event.evName
+            if sampled or event.evName != 'pthread_mutex_unlock':
+                # the lock may not have been recorded
+                lastLock = locks.remove(lambda lock: unlockOf(lock) and
+                                        lock.evArg1 == event.evArg1)
+                if lastLock is not None:
+                    self.lockBlock(lastLock, event.startTime)
+                return
+            lastLock = locks.remove(unlockOf)
+            assert lastLock is not None, 'Unlock of a mutex that is not locked'
             assert lastLock.evThread == event.evThread, 'Lock threads do not match'
             # TODO: in principle the lock-unlocks do not necessarily have to be nicely
             # nested. So, the data structure locks should be more intelligent in
@@ -271,8 +572,15 @@ class SPModel(object):
 
     def lockBlock(self, lockEvent, unlockEvStartTime):
         "emit a lock block"
-        extraArgs = {'lock': lockEvent.evArg1}
-        name = 'locked by ' + lockEvent.evArg1
+        _unlockName, kind, mode = LOCK_FUNCTIONS[lockEvent.evName]
+        extraArgs = {'lock': lockEvent.evArg1, 'kind': kind, 'mode': mode}
+        if kind == 'rwlock':
+            name = ('read-locked by ' if mode == 'shared' else 'write-locked by ') + \
+                lockEvent.evArg1
+        elif kind == 'spinlock':
+            name = 'spin-locked by ' + lockEvent.evArg1
+        else:
+            name = 'locked by ' + lockEvent.evArg1
         self.View.group('synchronization flow',
                         name,
                         lockEvent.stopTime,
@@ -282,6 +590,66 @@ class SPModel(object):
                         extraArgs)
 
 
+    def parallelRegions(self, event):
+        """track OpenMP parallel regions
+
+        A region runs from the start of GOMP_parallel_start (or a combined
+        variant like GOMP_parallel_loop_static_start) to the end of
+        GOMP_parallel_end in the same thread. GCC 4.9 and newer call
+        GOMP_parallel (or a combined variant without _start) once for the
+        whole region instead. Threads calling the OpenMP runtime meanwhile
+        belong to the innermost region. Loop scheduling calls returning true
+        count as chunks, and the calls ending with a team barrier as barrier
+        wait.
+        """
+        if not event.evName.startswith('GOMP_'):
+            return
+        parallel = event.evName.startswith('GOMP_parallel') and \
+            event.evName != 'GOMP_parallel_end'
+        if event.status in ('started', 'waiting'):
+            if parallel:
+                self.numOmpRegions += 1
+                self.ompRegions.append(SPOmpRegion(self.numOmpRegions,
+                                                   event.evThread,
+                                                   event.startTime))
+            return
+        region = self.ompRegion(event.evThread)
+        if region is None:
+            return
+        counts = region.threads.setdefault(event.evThread, [0, 0])
+        if event.evName.startswith('GOMP_loop_') and \
+                event.evName.endswith(('_start', '_next')) and returnedTrue(event):
+            counts[0] += 1
+        elif event.evName in self.ompBarriers:
+            counts[1] += event.stopTime - event.startTime
+        regionEnd = event.evName == 'GOMP_parallel_end' or \
+            parallel and not event.evName.endswith('_start')
+        if regionEnd and region.master == event.evThread:
+            self.ompRegions.remove(region)
+            self.ompRegionGroups(region, event.stopTime)
+
+    def ompRegion(self, thread):
+        "innermost parallel region of thread as master, or the innermost region"
+        for region in reversed(self.ompRegions):
+            if region.master == thread:
+                return region
+        return self.ompRegions[-1] if self.ompRegions else None
+
+    def ompRegionGroups(self, region, stopTime):
+        "emit a group for each thread of a finished parallel region"
+        for thread, (chunks, barrierWait) in sorted(region.threads.items()):
+            self.View.group('OpenMP',
+                            'parallel region %d' % region.number,
+                            region.startTime,
+                            thread,
+                            stopTime,
+                            thread,
+                            {'region': region.number,
+                             'master': region.master,
+                             'team': len(region.threads),
+                             'chunks': chunks,
+                             'barrier wait': barrierWait})
+
     def generateEvent(self, event):
         "generate new events based on event"
         # condition variable in POSIX imply hidden events"
@@ -330,14 +698,17 @@ class SPModel(object):
         # TODO: works well for chrome view, for text view it's wrong!
         pendEventPresent = False
         for threadDict in self.pendEventDict.values():
-            for event in threadDict['events']:
-                self.abortEvent(event)
+            events = threadDict['events']
+            while not events.empty():
+                self.abortEvent(events.top())
                 if not pendEventPresent:
                     # print only once a warning
                     self.log.warning('Unfinished events at the shutdown')
                 pendEventPresent = True
             for lock in threadDict['locks']:
                 self.lockBlock(lock, self.time)
+        while self.ompRegions:
+            self.ompRegionGroups(self.ompRegions.pop(), self.time)
         if pendEventPresent:
             self.View.mark('Event(s) aborted', 'WARNING', 'global', self.time, 1)
 
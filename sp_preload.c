@@ -0,0 +1,290 @@
+/*
+ * LD_PRELOAD interposition collector for sync-prof.
+ *
+ * The shim interposes the synchronization functions, which sp_preload.py
+ * lists in the header of a shared-memory ring buffer. Each call writes a
+ * start record before and a stop record after calling the real function.
+ * sp_preload.py drains the ring through mmap and feeds the records into the
+ * sync-prof model.
+ *
+ * Every wrapper forwards ten integer arguments, which covers the pthread,
+ * semaphore and GOMP functions traced by sync-prof on x86-64 and AArch64:
+ * unused argument registers and stack slots are passed through unchanged.
+ *
+ * At start-up the shim copies /proc/self/maps behind the header, so the
+ * reader can symbolize addresses even after a short-lived program exited.
+ *
+ * pthread_create() is special: it reports a nested clone event, whose stop
+ * record carries the new thread's TID and pthread_t like GDB's clone
+ * breakpoint.
+ *
+ * Build: cc -O2 -shared -fPIC -fno-builtin -o sp_preload.so sp_preload.c -ldl
+ */
+
+#define _GNU_SOURCE
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <sched.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <time.h>
+#include <unistd.h>
+
+/* stdlib.h is not included, because its exit() conflicts with the wrapper */
+extern char *getenv(const char *name);
+extern int unsetenv(const char *name);
+extern void *malloc(size_t size);
+extern void free(void *ptr);
+
+#define SP_MAGIC 0x5350524e47303031ULL /* "SPRNG001" */
+#define SP_HEADER_SIZE 16384
+#define SP_MAX_FUNCTIONS 256
+#define SP_NAME_SIZE 48
+#define SP_MAPS_SIZE 65536
+
+#define SP_KIND_START 1
+#define SP_KIND_STOP 2
+
+/* ring header, written by sp_preload.py except head and maps_length */
+struct sp_header {
+    uint64_t magic;
+    uint64_t capacity;  /* number of records, a power of 2 */
+    uint64_t head;      /* next record to reserve, advanced by the shim */
+    uint64_t tail;      /* next record to read, advanced by the reader */
+    uint32_t num_functions;
+    uint32_t maps_length; /* bytes of /proc/self/maps behind the header */
+    char names[SP_MAX_FUNCTIONS][SP_NAME_SIZE];
+};
+
+/* fixed-size record; seq is written last and marks the record complete */
+struct sp_record {
+    uint64_t seq;       /* reservation index + 1 */
+    uint64_t timestamp; /* CLOCK_MONOTONIC in nanoseconds */
+    uint32_t tid;
+    uint16_t function;  /* index in the header's name table */
+    uint8_t kind;
+    uint8_t pad;
+    uint64_t arg1;
+    uint64_t arg2;
+    uint64_t value;     /* caller PC on start, return value on stop */
+};
+
+typedef long (*sp_fun)(long, long, long, long, long, long, long, long, long, long);
+
+/* interposed functions: pthread_create and variadic functions are excluded */
+#define SP_FUNCTIONS(X) \
+    X(exit) X(sem_close) X(sem_destroy) X(sem_getvalue) X(sem_init) X(sem_post) \
+    X(sem_timedwait) X(sem_trywait) X(sem_unlink) X(sem_wait) \
+    X(pthread_barrier_destroy) X(pthread_barrier_init) X(pthread_barrier_wait) \
+    X(pthread_cancel) X(pthread_cond_broadcast) X(pthread_cond_destroy) \
+    X(pthread_cond_init) X(pthread_cond_signal) X(pthread_cond_timedwait) \
+    X(pthread_cond_wait) X(pthread_detach) X(pthread_exit) X(pthread_join) \
+    X(pthread_kill) X(pthread_mutex_destroy) X(pthread_mutex_init) \
+    X(pthread_mutex_lock) X(pthread_mutex_timedlock) X(pthread_mutex_trylock) \
+    X(pthread_mutex_unlock) X(pthread_once) X(pthread_rwlock_destroy) \
+    X(pthread_rwlock_init) X(pthread_rwlock_rdlock) X(pthread_rwlock_timedrdlock) \
+    X(pthread_rwlock_timedwrlock) X(pthread_rwlock_tryrdlock) \
+    X(pthread_rwlock_trywrlock) X(pthread_rwlock_unlock) X(pthread_rwlock_wrlock) \
+    X(pthread_spin_destroy) X(pthread_spin_init) X(pthread_spin_lock) \
+    X(pthread_spin_trylock) X(pthread_spin_unlock) X(pthread_timedjoin_np) \
+    X(pthread_tryjoin_np) X(pthread_yield) \
+    X(GOMP_atomic_end) X(GOMP_atomic_start) X(GOMP_barrier) X(GOMP_critical_end) \
+    X(GOMP_critical_name_end) X(GOMP_critical_name_start) X(GOMP_critical_start) \
+    X(GOMP_loop_dynamic_next) X(GOMP_loop_dynamic_start) X(GOMP_loop_end) \
+    X(GOMP_loop_end_nowait) X(GOMP_loop_guided_next) X(GOMP_loop_guided_start) \
+    X(GOMP_loop_runtime_next) X(GOMP_loop_runtime_start) X(GOMP_loop_static_next) \
+    X(GOMP_loop_static_start) X(GOMP_loop_start) X(GOMP_loop_end_cancel) \
+    X(GOMP_loop_nonmonotonic_dynamic_next) X(GOMP_loop_nonmonotonic_dynamic_start) \
+    X(GOMP_loop_nonmonotonic_guided_next) X(GOMP_loop_nonmonotonic_guided_start) \
+    X(GOMP_loop_nonmonotonic_runtime_next) X(GOMP_loop_nonmonotonic_runtime_start) \
+    X(GOMP_barrier_cancel) X(GOMP_ordered_end) X(GOMP_ordered_start) \
+    X(GOMP_parallel) X(GOMP_parallel_end) X(GOMP_parallel_start) \
+    X(GOMP_parallel_loop_dynamic) X(GOMP_parallel_loop_dynamic_start) \
+    X(GOMP_parallel_loop_guided) X(GOMP_parallel_loop_guided_start) \
+    X(GOMP_parallel_loop_runtime) X(GOMP_parallel_loop_runtime_start) \
+    X(GOMP_parallel_loop_static) X(GOMP_parallel_loop_static_start) \
+    X(GOMP_parallel_loop_nonmonotonic_dynamic) X(GOMP_parallel_loop_nonmonotonic_guided) \
+    X(GOMP_parallel_loop_nonmonotonic_runtime) \
+    X(GOMP_parallel_sections) X(GOMP_parallel_sections_start) \
+    X(GOMP_sections_end) X(GOMP_sections_end_nowait) X(GOMP_sections_next) \
+    X(GOMP_sections_start) X(GOMP_single_start) X(GOMP_task) X(GOMP_taskwait)
+
+#define SP_ENUM(name) SP_ID_##name,
+enum { SP_FUNCTIONS(SP_ENUM) SP_ID_pthread_create, SP_ID_clone, SP_NUM_IDS };
+
+#define SP_NAME(name) #name,
+static const char *sp_names[SP_NUM_IDS] = {
+    SP_FUNCTIONS(SP_NAME) "pthread_create", "clone"
+};
+
+static sp_fun sp_real[SP_NUM_IDS];
+/* record id of each function in the header's name table, -1 if not traced */
+static int sp_record_id[SP_NUM_IDS];
+static struct sp_header *sp_ring;
+static struct sp_record *sp_records;
+
+static uint32_t sp_gettid(void)
+{
+    return (uint32_t) syscall(SYS_gettid);
+}
+
+static uint64_t sp_now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t) ts.tv_sec * 1000000000ULL + (uint64_t) ts.tv_nsec;
+}
+
+static sp_fun sp_resolve(int id)
+{
+    if (sp_real[id] == NULL)
+        sp_real[id] = (sp_fun) dlsym(RTLD_NEXT, sp_names[id]);
+    return sp_real[id];
+}
+
+static void sp_write(int id, uint8_t kind, uint64_t arg1, uint64_t arg2, uint64_t value)
+{
+    uint64_t index, capacity;
+    struct sp_record *r;
+    if (sp_ring == NULL || sp_record_id[id] < 0)
+        return;
+    capacity = sp_ring->capacity;
+    index = __atomic_fetch_add(&sp_ring->head, 1, __ATOMIC_ACQ_REL);
+    /* the ring is full: wait for the reader rather than losing pairings */
+    while (index - __atomic_load_n(&sp_ring->tail, __ATOMIC_ACQUIRE) >= capacity)
+        sched_yield();
+    r = &sp_records[index & (capacity - 1)];
+    r->timestamp = sp_now();
+    r->tid = sp_gettid();
+    r->function = (uint16_t) sp_record_id[id];
+    r->kind = kind;
+    r->arg1 = arg1;
+    r->arg2 = arg2;
+    r->value = value;
+    __atomic_store_n(&r->seq, index + 1, __ATOMIC_RELEASE);
+}
+
+static void sp_copy_maps(struct sp_header *header)
+{
+    char *maps = (char *) header + SP_HEADER_SIZE;
+    uint32_t length = 0;
+    ssize_t n;
+    int fd = open("/proc/self/maps", O_RDONLY);
+    if (fd < 0)
+        return;
+    while (length < SP_MAPS_SIZE &&
+           (n = read(fd, maps + length, SP_MAPS_SIZE - length)) > 0)
+        length += (uint32_t) n;
+    close(fd);
+    __atomic_store_n(&header->maps_length, length, __ATOMIC_RELEASE);
+}
+
+__attribute__((constructor))
+static void sp_init(void)
+{
+    const char *path = getenv("SP_PRELOAD_RING");
+    struct stat st;
+    int fd, id;
+    uint32_t i;
+    void *ring;
+    for (id = 0; id < SP_NUM_IDS; id++) {
+        sp_record_id[id] = -1;
+        sp_resolve(id);
+    }
+    if (path == NULL)
+        return;
+    /* do not trace programs started by the profiled program */
+    unsetenv("LD_PRELOAD");
+    fd = open(path, O_RDWR);
+    if (fd < 0)
+        return;
+    if (fstat(fd, &st) != 0 || st.st_size < SP_HEADER_SIZE + SP_MAPS_SIZE) {
+        close(fd);
+        return;
+    }
+    ring = mmap(NULL, st.st_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (ring == MAP_FAILED)
+        return;
+    if (((struct sp_header *) ring)->magic != SP_MAGIC)
+        return;
+    for (i = 0; i < ((struct sp_header *) ring)->num_functions && i < SP_MAX_FUNCTIONS; i++)
+        for (id = 0; id < SP_NUM_IDS; id++)
+            if (strncmp(((struct sp_header *) ring)->names[i], sp_names[id],
+                        SP_NAME_SIZE) == 0)
+                sp_record_id[id] = (int) i;
+    sp_copy_maps((struct sp_header *) ring);
+    sp_records = (struct sp_record *) ((char *) ring + SP_HEADER_SIZE + SP_MAPS_SIZE);
+    sp_ring = (struct sp_header *) ring;
+}
+
+#define SP_WRAP(name) \
+    long name(long a1, long a2, long a3, long a4, long a5, \
+              long a6, long a7, long a8, long a9, long a10) \
+    { \
+        long ret; \
+        sp_write(SP_ID_##name, SP_KIND_START, (uint64_t) a1, (uint64_t) a2, \
+                 (uint64_t) __builtin_return_address(0)); \
+        ret = sp_resolve(SP_ID_##name)(a1, a2, a3, a4, a5, a6, a7, a8, a9, a10); \
+        sp_write(SP_ID_##name, SP_KIND_STOP, (uint64_t) a1, (uint64_t) a2, \
+                 (uint64_t) ret); \
+        return ret; \
+    }
+
+SP_FUNCTIONS(SP_WRAP)
+
+/* start arguments of a new thread; tid is published by the new thread */
+struct sp_start {
+    void *(*routine)(void *);
+    void *arg;
+    uint32_t tid;
+};
+
+static void *sp_start_thread(void *start)
+{
+    struct sp_start *s = (struct sp_start *) start;
+    void *(*routine)(void *) = s->routine;
+    void *arg = s->arg;
+    /* the creator frees start after reading the tid */
+    __atomic_store_n(&s->tid, sp_gettid(), __ATOMIC_RELEASE);
+    return routine(arg);
+}
+
+long pthread_create(unsigned long *thread, const void *attr,
+                    void *(*routine)(void *), void *arg)
+{
+    long ret;
+    struct sp_start *start;
+    uint32_t tid;
+    sp_write(SP_ID_pthread_create, SP_KIND_START, (uint64_t) thread, (uint64_t) attr,
+             (uint64_t) __builtin_return_address(0));
+    start = (struct sp_start *) malloc(sizeof(struct sp_start));
+    if (start == NULL) {
+        ret = sp_resolve(SP_ID_pthread_create)((long) thread, (long) attr, (long) routine,
+                                               (long) arg, 0, 0, 0, 0, 0, 0);
+    } else {
+        start->routine = routine;
+        start->arg = arg;
+        start->tid = 0;
+        sp_write(SP_ID_clone, SP_KIND_START, (uint64_t) thread, (uint64_t) attr,
+                 (uint64_t) __builtin_return_address(0));
+        ret = sp_resolve(SP_ID_pthread_create)((long) thread, (long) attr,
+                                               (long) sp_start_thread, (long) start,
+                                               0, 0, 0, 0, 0, 0);
+        tid = 0;
+        if (ret == 0)
+            while ((tid = __atomic_load_n(&start->tid, __ATOMIC_ACQUIRE)) == 0)
+                sched_yield();
+        /* clone's stop record holds the new thread's TID and pthread_t */
+        sp_write(SP_ID_clone, SP_KIND_STOP, ret == 0 ? (uint64_t) *thread : 0, 0,
+                 (uint64_t) tid);
+        free(start);
+    }
+    sp_write(SP_ID_pthread_create, SP_KIND_STOP, (uint64_t) thread, (uint64_t) attr,
+             (uint64_t) ret);
+    return ret;
+}
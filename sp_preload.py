@@ -0,0 +1,252 @@
+"""
+LD_PRELOAD collector for sync-prof.
+
+An alternative to the GDB collector, which costs two ptrace stops per traced
+call. The program runs with the sp_preload.c shim preloaded. The shim writes
+fixed-size records of the traced calls into a shared-memory ring buffer, and
+SPPreloadCollector drains the ring through mmap into the model (or the raw
+log writer). Both collectors produce the same event stream, so the views do
+not depend on the collector.
+"""
+
+
+import hashlib
+import mmap
+import os
+import platform
+import struct
+import subprocess
+import tempfile
+import time
+
+import sp_symbols
+
+
+# must match sp_preload.c
+MAGIC = 0x5350524e47303031
+HEADER_SIZE = 16384
+MAX_FUNCTIONS = 256
+NAME_SIZE = 48
+MAPS_SIZE = 65536
+KIND_START = 1
+KIND_STOP = 2
+# magic, capacity, head, tail, number of functions, length of the maps copy
+HEADER = struct.Struct('<QQQQII')
+TAIL_OFFSET = 24
+MAPS_LENGTH_OFFSET = 36
+# seq, timestamp, tid, function, kind, pad, arg1, arg2, value
+RECORD = struct.Struct('<QQIHBBQQQ')
+SEQ = struct.Struct('<Q')
+# the drain relies on the hardware keeping the order of loads, Python has no barriers
+MACHINES = ('x86_64', 'amd64')
+
+# default number of records in the ring buffer, a power of 2
+CAPACITY = 1 << 16
+# seconds between memory map snapshots of the running program
+MAPS_INTERVAL = 0.1
+
+
+def buildShim(spDirName, log):
+    "compile the shim into the cache directory unless it is up to date"
+    assert platform.machine().lower() in MACHINES, \
+        'the preload collector supports only x86-64, use --collector gdb'
+    source = os.path.join(spDirName, 'sp_preload.c')
+    with open(source, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    cacheDir = os.path.dirname(sp_symbols.cacheDir())
+    library = os.path.join(cacheDir, 'sp_preload-%s.so' % digest)
+    if not os.path.exists(library):
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        cmd = ['cc', '-O2', '-shared', '-fPIC', '-fno-builtin',
+               '-o', library, source, '-ldl']
+        log.info('building the preload shim: %s' % cmd)
+        subprocess.check_call(cmd)
+    return library
+
+
+class SPPreloadCollector(object):
+    "run a program with the preload shim and pass its records to the model"
+    def __init__(self, functions, model, symbolizer, backtrace, log, capacity=CAPACITY):
+        # unique function names in the order of the config file
+        self.functions = []
+        for fun in functions:
+            if fun not in self.functions and len(self.functions) < MAX_FUNCTIONS:
+                self.functions.append(fun)
+        self.model = model
+        self.symbolizer = symbolizer # None keeps raw addresses
+        self.backtrace = backtrace
+        self.log = log
+        self.capacity = capacity
+        self.syncHits = dict((fun, 0) for fun in self.functions)
+        self.threads = {} # TID -> thread number as in GDB
+        self.pendEvents = {} # TID -> stack of (function, event)
+        self.pid = None
+        self.ring = None
+        self.maps = None # last memory map passed on
+        self.mapsTime = 0
+        if symbolizer is not None:
+            model.stacks.resolve = self.frameName
+
+    def run(self, library, program, programArgs):
+        "run program to completion; return its exit code"
+        fd, ringFile = tempfile.mkstemp(prefix='sync-prof-ring-',
+                                        dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        try:
+            size = HEADER_SIZE + MAPS_SIZE + self.capacity * RECORD.size
+            os.ftruncate(fd, size)
+            ring = mmap.mmap(fd, size)
+            self.ring = ring
+            HEADER.pack_into(ring, 0, MAGIC, self.capacity, 0, 0, len(self.functions), 0)
+            for i, fun in enumerate(self.functions):
+                name = fun.encode('utf-8')[:NAME_SIZE - 1]
+                ring[HEADER.size + i * NAME_SIZE:HEADER.size + i * NAME_SIZE + len(name)] = name
+            env = dict(os.environ)
+            env['LD_PRELOAD'] = library
+            env['SP_PRELOAD_RING'] = ringFile
+            proc = subprocess.Popen(program + programArgs, env=env)
+            self.pid = proc.pid
+            self.threads[proc.pid] = 1
+            tail = 0
+            interrupted = False
+            try:
+                while proc.poll() is None:
+                    if time.time() - self.mapsTime > MAPS_INTERVAL:
+                        self.snapshotMaps()
+                    drained = self.drain(ring, tail)
+                    if drained == tail:
+                        self.model.watchdog()
+                        time.sleep(0.001)
+                    tail = drained
+            except KeyboardInterrupt:
+                self.log.warning('interrupted, stopping the program')
+                interrupted = True
+                proc.terminate()
+                proc.wait()
+            self.pid = None
+            # records committed before the program exited
+            self.snapshotMaps()
+            self.drain(ring, tail)
+            # while the calls of a hang are still pending
+            if interrupted:
+                self.model.dump('interrupted')
+            self.model.dump('end of the run', final=True)
+            self.abortPending()
+            self.ring = None
+            ring.close()
+            return proc.returncode
+        finally:
+            os.close(fd)
+            os.remove(ringFile)
+
+    def drain(self, ring, tail):
+        "process the complete records from tail on; return the new tail"
+        mask = self.capacity - 1
+        while True:
+            offset = HEADER_SIZE + MAPS_SIZE + (tail & mask) * RECORD.size
+            # seqlock style: the writer publishes seq after the payload, so load
+            # seq on its own before the payload and check it again after
+            if SEQ.unpack_from(ring, offset)[0] != tail + 1:
+                break
+            record = RECORD.unpack_from(ring, offset)
+            if SEQ.unpack_from(ring, offset)[0] != tail + 1:
+                break
+            self.record(*record[1:])
+            tail += 1
+            # let the writers reuse the slot
+            struct.pack_into('<Q', ring, TAIL_OFFSET, tail)
+        return tail
+
+    def record(self, timestamp, tid, function, kind, _pad, arg1, arg2, value):
+        "pass a record to the model"
+        name = self.functions[function]
+        timestamp = timestamp / 1e9
+        thread = self.thread(tid)
+        pendEvents = self.pendEvents.setdefault(tid, [])
+        if kind == KIND_START:
+            self.syncHits[name] += 1
+            stack = None
+            if self.backtrace != 'off':
+                # the shim knows only the caller
+                stack = self.model.stacks.intern((value,))
+            event = self.model.startEvent(name, 'function', thread,
+                                          self.argument(arg1),
+                                          self.argument(arg2),
+                                          None, '?', '?', stack, False,
+                                          pc=value, timestamp=timestamp)
+            pendEvents.append((name, event))
+        else:
+            if not pendEvents or pendEvents[-1][0] != name:
+                self.log.warning('unexpected return from %s in thread %d' % (name, thread))
+                return
+            _name, event = pendEvents.pop()
+            if event is None:
+                # skipped by the model inside an opaque event
+                return
+            if name == 'clone' and value != 0:
+                event.evNewThread = {'gdb': self.thread(value),
+                                     'pthread_t': '0x%x' % arg1}
+            event.evValue = value # return value
+            self.model.stopEvent(event, timestamp)
+
+    def abortPending(self):
+        "abort the calls that did not return before the program exited, e.g. exit()"
+        for pendEvents in self.pendEvents.values():
+            while pendEvents:
+                _name, event = pendEvents.pop()
+                if event is not None:
+                    self.model.abortEvent(event)
+
+    def thread(self, tid):
+        "thread number of TID numbered in the order of appearance"
+        if tid not in self.threads:
+            self.threads[tid] = len(self.threads) + 1
+        return self.threads[tid]
+
+    def argument(self, address):
+        "symbol of an argument address, or the address for the raw log"
+        if self.symbolizer is None:
+            return address
+        if self.maps is None:
+            self.snapshotMaps()
+        symbol = self.symbolizer.symbol(address)
+        return symbol if symbol is not None else '0x%x' % address
+
+    def frameName(self, pc):
+        "symbol of a caller PC"
+        return self.argument(pc)
+
+    def snapshotMaps(self):
+        """pass the memory map of the program to the symbolizer or the raw log
+
+        The running program's /proc/<pid>/maps is preferred, otherwise the
+        copy the shim took at start-up.
+        """
+        self.mapsTime = time.time()
+        if self.ring is None:
+            return
+        length = struct.unpack_from('<I', self.ring, MAPS_LENGTH_OFFSET)[0]
+        if length == 0:
+            return # the program is not loaded yet
+        maps = None
+        if self.pid is not None:
+            try:
+                maps = sp_symbols.readMaps(self.pid)
+            except (IOError, OSError):
+                pass
+        if not maps and self.maps is None:
+            maps = self.ring[HEADER_SIZE:HEADER_SIZE + length].decode('utf-8', 'replace')
+        if not maps or maps == self.maps:
+            return
+        self.maps = maps
+        if self.symbolizer is None:
+            self.model.addMaps(maps)
+        else:
+            self.symbolizer.addMaps(maps)
+
+    def printSummary(self):
+        "print hit counts for each sync point"
+        print('\nSynchronization point occurences:')
+        for fun in self.functions:
+            if self.syncHits[fun] > 0:
+                print('{:<40}{:<10}'.format(fun, self.syncHits[fun]))
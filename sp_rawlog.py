@@ -0,0 +1,343 @@
+"""
+Compact binary log of raw synchronization events.
+
+In the raw capture mode the collector does not run the model and the views
+while the inferior is stopped. Instead, SPRawLogWriter appends fixed-layout
+records to a binary log. After the run, replay() feeds the log through
+SPModel and any view, so the same capture can be rendered in several formats.
+
+Log layout: the MAGIC header followed by records. Each record starts with a
+one byte record kind:
+
+- STRING: string table entry (id, length, UTF-8 bytes). Strings (function
+  names, source files, symbolic arguments) are stored once and
+  referenced by their id in the event records. Id 0 stands for None.
+- START: start of a function or an access event. Integer arguments are
+  stored as raw addresses.
+- STACK: interned call stack (id, depth, PCs innermost first) referenced by
+  START records
+- STOP: end of a function event with its return value if known
+- ABORT: end of a function event that did not return
+- MAPS: snapshot of /proc/<pid>/maps (length, text) for symbolizing the
+  addresses in bulk at replay
+- SAMPLED: string id of a function not recorded on every call
+"""
+
+
+import struct
+
+from sp_util import SPStack, clock
+
+
+MAGIC = b'SPRAW006'
+
+KIND_STRING = 1
+KIND_START = 2
+KIND_STOP = 3
+KIND_MAPS = 4
+KIND_STACK = 5
+KIND_SAMPLED = 6
+KIND_ABORT = 7
+
+# START flags
+FLAG_ACCESS = 1
+FLAG_OPAQUE = 2
+FLAG_ARG1_ADDRESS = 4
+FLAG_ARG2_ADDRESS = 8
+
+# kind, string id, length
+STRING = struct.Struct('<BII')
+# kind, seq, thread, name, flags, arg1, arg2, value, filename, line, stack id,
+# pc, timestamp
+START = struct.Struct('<BIIIBQQIIiIQd')
+# STOP flags
+FLAG_VALUE = 1
+
+# kind, seq, new thread (0 if none), new thread's pthread_t, flags, return value,
+# timestamp
+STOP = struct.Struct('<BIIIBQd')
+# kind, length
+MAPS = struct.Struct('<BI')
+# kind, stack id, depth; followed by depth PCs
+STACK = struct.Struct('<BIH')
+# kind, string id
+SAMPLED = struct.Struct('<BI')
+# kind, seq, timestamp
+ABORT = struct.Struct('<BId')
+
+# Python 2 returns big addresses as long
+INTEGER_TYPES = (int, type(2 ** 64))
+
+
+class SPRawEvent(object):
+    "handle of a captured event, passed back to the writer on stop"
+    __slots__ = ['seq', 'evName', 'evThread', 'evOpaque', 'evNewThread', 'evValue']
+    def __init__(self, seq, evName, evThread, evOpaque):
+        self.seq = seq
+        self.evName = evName
+        self.evThread = evThread
+        self.evOpaque = evOpaque
+        self.evNewThread = None
+        self.evValue = None # return value
+    def toString(self):
+        return '%s thread %d seq %d' % (self.evName, self.evThread, self.seq)
+
+
+class SPRawStackTable(object):
+    "stack table of the raw log writer; stacks are logged on first use"
+    def __init__(self, outFile):
+        self.outFile = outFile
+        self.stacks = {}
+    def intern(self, pcs):
+        "return the id of the stack with PCs, logging it if needed"
+        if pcs in self.stacks:
+            return self.stacks[pcs]
+        stackId = len(self.stacks) + 1
+        self.stacks[pcs] = stackId
+        self.outFile.write(STACK.pack(KIND_STACK, stackId, len(pcs)) +
+                           struct.pack('<%dQ' % len(pcs), *pcs))
+        return stackId
+
+
+class SPRawLogWriter(object):
+    "event sink with the controller's interface of SPModel writing a raw log"
+    def __init__(self, outFile, log):
+        self.outFile = open(outFile, 'wb')
+        self.outFile.write(MAGIC)
+        self.log = log
+        self.strings = {None: 0}
+        self.stacks = SPRawStackTable(self.outFile)
+        self.seq = 0
+        # per thread stacks of pending events to skip events inside opaque ones
+        self.pendEvents = {}
+        self.closed = False
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        "flush and close the log; safe to call more than once"
+        if not self.closed:
+            self.closed = True
+            self.outFile.close()
+
+    def stringId(self, string):
+        "return id of string, adding it to the string table if needed"
+        if string in self.strings:
+            return self.strings[string]
+        sid = len(self.strings)
+        self.strings[string] = sid
+        data = str(string).encode('utf-8')
+        self.outFile.write(STRING.pack(KIND_STRING, sid, len(data)) + data)
+        return sid
+
+    def argument(self, arg):
+        "raw value and flag of an argument: address or string id"
+        if isinstance(arg, INTEGER_TYPES):
+            return arg, True
+        return self.stringId(arg), False
+
+    def addMaps(self, maps):
+        "log a /proc/<pid>/maps snapshot"
+        data = maps.encode('utf-8')
+        self.outFile.write(MAPS.pack(KIND_MAPS, len(data)) + data)
+
+    def dump(self, reason, final=False):
+        "the raw log keeps all events, so there is no flight recorder to dump"
+        pass
+
+    def watchdog(self):
+        pass
+
+    def sampled(self, evName):
+        "log that not every call of evName is recorded"
+        self.outFile.write(SAMPLED.pack(KIND_SAMPLED, self.stringId(evName)))
+
+    def startEvent(self, evName, evType, evThread, evArg1, evArg2, evValue, evFilename,
+                   evLine, evBacktrace, evOpaque, pc=None, timestamp=None):
+        "log the start of an event; None if it happens inside an opaque event"
+        threadEvents = self.pendEvents.setdefault(evThread, SPStack())
+        if not threadEvents.empty() and threadEvents.top().evOpaque:
+            return None
+        self.seq += 1
+        event = SPRawEvent(self.seq, evName, evThread, evOpaque)
+        line = evLine if isinstance(evLine, int) else -1
+        arg1, arg1Address = self.argument(evArg1)
+        arg2, arg2Address = self.argument(evArg2)
+        flags = (FLAG_ACCESS if evType == 'access' else 0) | \
+            (FLAG_OPAQUE if evOpaque else 0) | \
+            (FLAG_ARG1_ADDRESS if arg1Address else 0) | \
+            (FLAG_ARG2_ADDRESS if arg2Address else 0)
+        self.outFile.write(START.pack(KIND_START,
+                                      event.seq,
+                                      evThread,
+                                      self.stringId(evName),
+                                      flags,
+                                      arg1,
+                                      arg2,
+                                      self.stringId(evValue),
+                                      self.stringId(evFilename),
+                                      line,
+                                      evBacktrace or 0,
+                                      pc or 0,
+                                      clock() if timestamp is None else timestamp))
+        # access events are atomic and have no stop record
+        if evType != 'access':
+            threadEvents.push(event)
+        return event
+
+    def stopEvent(self, event, timestamp=None):
+        "log the end of an event"
+        self.dropEvent(event)
+        if event.evNewThread is None:
+            newThread, pthread = 0, 0
+        else:
+            newThread = event.evNewThread['gdb']
+            pthread = self.stringId(event.evNewThread['pthread_t'])
+        if timestamp is None:
+            timestamp = clock()
+        flags, value = 0, 0
+        if isinstance(event.evValue, INTEGER_TYPES):
+            flags, value = FLAG_VALUE, event.evValue & 0xffffffffffffffff
+        self.outFile.write(STOP.pack(KIND_STOP, event.seq, newThread, pthread, flags, value,
+                                     timestamp))
+
+    def abortEvent(self, event, timestamp=None):
+        "log the end of an event that did not return"
+        self.dropEvent(event)
+        if timestamp is None:
+            timestamp = clock()
+        self.outFile.write(ABORT.pack(KIND_ABORT, event.seq, timestamp))
+
+    def dropEvent(self, event):
+        "remove the event from the pending events of its thread"
+        threadEvents = self.pendEvents[event.evThread]
+        assert event == threadEvents.top(), \
+            'Event %s must be the last element of its thread' % event.toString()
+        threadEvents.pop()
+
+
+def readRecords(logFile):
+    """generate (kind, fields) tuples from a raw log, resolving string ids
+
+    Address arguments are returned as integers.
+    """
+    strings = {0: None}
+    with open(logFile, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, '%s is not a sync-prof raw log' % logFile
+        while True:
+            kind = f.read(1)
+            if kind == b'':
+                break
+            kind = bytearray(kind)[0]
+            if kind == KIND_STRING:
+                _kind, sid, length = STRING.unpack(kindBytes(kind) + f.read(STRING.size - 1))
+                strings[sid] = f.read(length).decode('utf-8')
+            elif kind == KIND_START:
+                fields = START.unpack(kindBytes(kind) + f.read(START.size - 1))
+                (_kind, seq, thread, name, flags, arg1, arg2, value, filename,
+                 line, backtrace, pc, timestamp) = fields
+                yield kind, {'seq': seq,
+                             'evName': strings[name],
+                             'evType': 'access' if flags & FLAG_ACCESS else 'function',
+                             'evThread': thread,
+                             'evArg1': arg1 if flags & FLAG_ARG1_ADDRESS else strings[arg1],
+                             'evArg2': arg2 if flags & FLAG_ARG2_ADDRESS else strings[arg2],
+                             'evValue': strings[value],
+                             'evFilename': strings[filename],
+                             'evLine': line if line >= 0 else '?',
+                             'evBacktrace': backtrace or None,
+                             'evOpaque': bool(flags & FLAG_OPAQUE),
+                             'pc': pc,
+                             'timestamp': timestamp}
+            elif kind == KIND_STOP:
+                _kind, seq, newThread, pthread, flags, value, timestamp = \
+                    STOP.unpack(kindBytes(kind) + f.read(STOP.size - 1))
+                yield kind, {'seq': seq,
+                             'newThread': newThread,
+                             'pthread_t': strings[pthread],
+                             'evValue': value if flags & FLAG_VALUE else None,
+                             'timestamp': timestamp}
+            elif kind == KIND_MAPS:
+                _kind, length = MAPS.unpack(kindBytes(kind) + f.read(MAPS.size - 1))
+                yield kind, {'maps': f.read(length).decode('utf-8')}
+            elif kind == KIND_STACK:
+                _kind, stackId, depth = STACK.unpack(kindBytes(kind) + f.read(STACK.size - 1))
+                pcs = struct.unpack('<%dQ' % depth, f.read(8 * depth))
+                yield kind, {'stackId': stackId, 'pcs': pcs}
+            elif kind == KIND_SAMPLED:
+                _kind, name = SAMPLED.unpack(kindBytes(kind) + f.read(SAMPLED.size - 1))
+                yield kind, {'evName': strings[name]}
+            elif kind == KIND_ABORT:
+                _kind, seq, timestamp = ABORT.unpack(kindBytes(kind) + f.read(ABORT.size - 1))
+                yield kind, {'seq': seq, 'timestamp': timestamp}
+            else:
+                raise AssertionError('unknown record kind %d in %s' % (kind, logFile))
+
+
+def kindBytes(kind):
+    "one byte string holding the record kind"
+    return struct.pack('<B', kind)
+
+
+def symbolize(logFile, symbolizer):
+    "resolve all distinct address arguments of a raw log in bulk"
+    addresses = set()
+    for kind, fields in readRecords(logFile):
+        if kind == KIND_MAPS:
+            symbolizer.addMaps(fields['maps'])
+        elif kind == KIND_START:
+            for arg in [fields['evArg1'], fields['evArg2']]:
+                if isinstance(arg, INTEGER_TYPES):
+                    addresses.add(arg)
+    return symbolizer.symbolize(addresses)
+
+
+def replay(logFile, model, symbolizer):
+    "feed the events of a raw log through model"
+    symbols = symbolize(logFile, symbolizer)
+    def argument(arg):
+        return symbols[arg] if isinstance(arg, INTEGER_TYPES) else arg
+    def frameName(pc):
+        name = symbolizer.symbol(pc)
+        return name if name is not None else '0x%x' % pc
+    model.stacks.resolve = frameName
+    stacks = {None: None} # stack id in the log -> stack id in the model
+    pendEvents = {}
+    for kind, fields in readRecords(logFile):
+        if kind == KIND_MAPS:
+            continue
+        elif kind == KIND_STACK:
+            stacks[fields['stackId']] = model.stacks.intern(fields['pcs'])
+        elif kind == KIND_SAMPLED:
+            model.sampled(fields['evName'])
+        elif kind == KIND_ABORT:
+            event = pendEvents.pop(fields['seq'], None)
+            if event is not None:
+                model.abortEvent(event, fields['timestamp'])
+        elif kind == KIND_START:
+            event = model.startEvent(fields['evName'],
+                                     fields['evType'],
+                                     fields['evThread'],
+                                     argument(fields['evArg1']),
+                                     argument(fields['evArg2']),
+                                     fields['evValue'],
+                                     fields['evFilename'],
+                                     fields['evLine'],
+                                     stacks[fields['evBacktrace']],
+                                     fields['evOpaque'],
+                                     pc=fields['pc'],
+                                     timestamp=fields['timestamp'])
+            if event is not None and fields['evType'] != 'access':
+                pendEvents[fields['seq']] = event
+        else:
+            event = pendEvents.pop(fields['seq'], None)
+            if event is None:
+                model.log.warning('stop record %d without a start' % fields['seq'])
+                continue
+            if fields['newThread'] != 0:
+                event.evNewThread = {'gdb': fields['newThread'],
+                                     'pthread_t': fields['pthread_t']}
+            if fields['evValue'] is not None:
+                event.evValue = fields['evValue']
+            model.stopEvent(event, fields['timestamp'])
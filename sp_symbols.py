@@ -0,0 +1,202 @@
+"""
+Symbolization of addresses with the ELF symbol tables of the loaded binaries.
+
+The collectors record raw addresses together with snapshots of
+/proc/<pid>/maps. SPSymbolizer resolves each distinct address once, without
+debugger round trips. The symbol tables parsed from each binary are kept in a
+persistent cache, so repeat runs on the same build skip parsing.
+"""
+
+
+import bisect
+import hashlib
+import json
+import os
+import struct
+
+
+ET_EXEC = 2
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+# symbol types worth reporting: object, function, common and indirect function
+STT_TYPES = [1, 2, 5, 10]
+PAGE_MASK = ~0xfff
+
+
+def cacheDir():
+    "directory of the persistent symbol table cache"
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'sync-prof', 'symbols')
+
+
+def readMaps(pid):
+    "return the text of /proc/<pid>/maps"
+    with open('/proc/%d/maps' % pid, 'r') as f:
+        return f.read()
+
+
+def parseMaps(maps):
+    "list of (start, end, offset, path) of file mappings in a maps snapshot"
+    mappings = []
+    for line in maps.splitlines():
+        fields = line.split(None, 5)
+        if len(fields) < 6 or not fields[5].startswith('/'):
+            continue
+        start, end = [int(a, 16) for a in fields[0].split('-')]
+        mappings.append((start, end, int(fields[2], 16), fields[5].strip()))
+    return mappings
+
+
+def readElfSymbols(path):
+    "parse the ELF file path into a dict with its load segments and symbols"
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data[:4] == b'\x7fELF', '%s is not an ELF file' % path
+    is64 = bytearray(data[4:5])[0] == 2
+    endian = '<' if bytearray(data[5:6])[0] == 1 else '>'
+    if is64:
+        ehdr = struct.unpack_from(endian + 'HHIQQQIHHHHHH', data, 16)
+        phdr, shdr, sym = endian + 'IIQQQQQQ', endian + 'IIQQQQIIQQ', endian + 'IBBHQQ'
+    else:
+        ehdr = struct.unpack_from(endian + 'HHIIIIIHHHHHH', data, 16)
+        phdr, shdr, sym = endian + 'IIIIIIII', endian + 'IIIIIIIIII', endian + 'IIIBBH'
+    eType, phoff, shoff = ehdr[0], ehdr[4], ehdr[5]
+    phentsize, phnum, shentsize, shnum = ehdr[8], ehdr[9], ehdr[10], ehdr[11]
+    # load segments as (vaddr, offset, memsz)
+    segments = []
+    for i in range(phnum):
+        p = struct.unpack_from(phdr, data, phoff + i * phentsize)
+        if is64:
+            pType, pOffset, pVaddr, pMemsz = p[0], p[2], p[3], p[6]
+        else:
+            pType, pOffset, pVaddr, pMemsz = p[0], p[1], p[2], p[5]
+        if pType == PT_LOAD:
+            segments.append((pVaddr, pOffset, pMemsz))
+    sections = [struct.unpack_from(shdr, data, shoff + i * shentsize) for i in range(shnum)]
+    symbols = {}
+    for section in sections:
+        shType, shOffset, shSize, shLink, shEntsize = \
+            section[1], section[4], section[5], section[6], section[9]
+        if shType not in [SHT_SYMTAB, SHT_DYNSYM] or shEntsize == 0:
+            continue
+        strOffset = sections[shLink][4]
+        for i in range(shSize // shEntsize):
+            s = struct.unpack_from(sym, data, shOffset + i * shEntsize)
+            if is64:
+                stName, stInfo, stShndx, stValue, stSize = s[0], s[1], s[3], s[4], s[5]
+            else:
+                stName, stValue, stSize, stInfo, stShndx = s[0], s[1], s[2], s[3], s[5]
+            if stShndx == 0 or stValue == 0 or (stInfo & 0xf) not in STT_TYPES:
+                continue
+            end = data.index(b'\0', strOffset + stName)
+            name = data[strOffset + stName:end].decode('utf-8', 'replace')
+            symbols[(stValue, name)] = stSize
+    return {'type': eType,
+            'segments': segments,
+            'symbols': sorted([v, size, n] for (v, n), size in symbols.items())}
+
+
+def loadElfSymbols(path):
+    "symbols of the ELF file path, from the persistent cache if it is up to date"
+    st = os.stat(path)
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    cacheFile = os.path.join(cacheDir(), key + '.json')
+    try:
+        with open(cacheFile, 'r') as f:
+            cached = json.load(f)
+        if cached['path'] == path and cached['mtime'] == st.st_mtime and \
+                cached['size'] == st.st_size:
+            return cached['elf']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    elf = readElfSymbols(path)
+    try:
+        if not os.path.isdir(cacheDir()):
+            os.makedirs(cacheDir())
+        tmpFile = '%s.%d' % (cacheFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'path': path, 'mtime': st.st_mtime, 'size': st.st_size, 'elf': elf}, f)
+        os.rename(tmpFile, cacheFile)
+    except (IOError, OSError):
+        pass # the cache is an optimization only
+    return elf
+
+
+class SPModule(object):
+    "ELF binary loaded at an address bias"
+    def __init__(self, path, elf, bias):
+        self.path = path
+        self.bias = bias
+        self.low = min(s[0] for s in elf['segments']) + bias
+        self.high = max(s[0] + s[2] for s in elf['segments']) + bias
+        self.values = [s[0] for s in elf['symbols']]
+        self.symbols = elf['symbols']
+    def contains(self, address):
+        "True if address is inside the loaded segments"
+        return self.low <= address < self.high
+    def symbol(self, address):
+        "name of the symbol covering address or None"
+        i = bisect.bisect_right(self.values, address - self.bias) - 1
+        if i < 0:
+            return None
+        value, size, name = self.symbols[i]
+        if address - self.bias < value + max(size, 1):
+            return name
+        return None
+
+
+class SPSymbolizer(object):
+    "resolve addresses to symbol names using maps snapshots of the process"
+    def __init__(self, log):
+        self.log = log
+        self.modules = {} # (path, bias) -> SPModule
+        self.cache = {}
+
+    def addMaps(self, maps):
+        "add modules of a /proc/<pid>/maps snapshot"
+        firstMappings = {}
+        for start, _end, offset, path in parseMaps(maps):
+            if path not in firstMappings or offset < firstMappings[path][1]:
+                firstMappings[path] = (start, offset)
+        for path, (start, offset) in firstMappings.items():
+            try:
+                elf = loadElfSymbols(path)
+            except (IOError, OSError, AssertionError, struct.error) as e:
+                self.log.debug('no symbols for %s: %s' % (path, e))
+                continue
+            if not elf['segments']:
+                continue
+            if elf['type'] == ET_EXEC:
+                bias = 0
+            else:
+                # the mapping with the lowest offset maps the matching segment
+                segments = [s for s in elf['segments'] if s[1] & PAGE_MASK == offset]
+                if not segments:
+                    continue
+                bias = start - (segments[0][0] & PAGE_MASK)
+            if (path, bias) not in self.modules:
+                self.modules[(path, bias)] = SPModule(path, elf, bias)
+        # addresses unknown so far may belong to the new modules
+        self.cache = dict((a, n) for a, n in self.cache.items() if n is not None)
+
+    def symbol(self, address):
+        "symbol name of address or None"
+        if address in self.cache:
+            return self.cache[address]
+        name = None
+        for module in self.modules.values():
+            if module.contains(address):
+                name = module.symbol(address)
+                if name is not None:
+                    break
+        self.cache[address] = name
+        return name
+
+    def symbolize(self, addresses):
+        "resolve many addresses at once; return dict address->name or hex string"
+        result = {}
+        for address in sorted(set(addresses)):
+            name = self.symbol(address)
+            result[address] = name if name is not None else '0x%x' % address
+        return result
@@ -8,36 +8,283 @@ TODO:
 
 
 import logging
+import numbers
+import sys
+import time
+
+
+# monotonic clock in seconds; Python 2 falls back to the wall clock
+clock = getattr(time, 'monotonic', time.time)
+
+
+try:
+    intern = sys.intern
+except AttributeError:
+    intern = intern # built-in in Python 2
+
+
+def internString(value):
+    "return the shared copy of a string value; other values are returned as they are"
+    if type(value) is str:
+        return intern(value)
+    return value
 
 
 # TODO: exception handling
-# TODO: refactor sp_model to use SPStack
 class SPStack(object):
     "simple LIFO"
+    __slots__ = ['stack']
     def __init__(self):
         self.stack = []
     def push(self, lmn):
         "push to stack"
-        self.stack += [lmn]
+        self.stack.append(lmn)
     def top(self):
         "return top of the stack"
-        assert not self.empty(), 'stack empty'
+        assert self.stack, 'stack empty'
         return self.stack[-1]
     def pop(self):
         "pop the top of the stack"
-        lmn = self.top()
-        self.stack = self.stack[:-1]
-        return lmn
+        assert self.stack, 'stack empty'
+        return self.stack.pop()
+    def remove(self, match):
+        "remove and return the topmost element for which match is True, or None"
+        for i in range(len(self.stack) - 1, -1, -1):
+            if match(self.stack[i]):
+                return self.stack.pop(i)
+        return None
     def size(self):
         "return number of elements in stack"
         return len(self.stack)
     def empty(self):
         "True if stack is empty"
-        return self.stack == []
+        return not self.stack
     def __iter__(self):
-        "iterator over stack elements, top element first"
-        for lmn in self.stack[::-1]:
-            yield lmn
+        "iterator over stack elements, top element first; do not modify the stack meanwhile"
+        return reversed(self.stack)
+
+
+class SPStackTable(object):
+    """interned call stacks
+
+    A call stack is a tuple of PCs, innermost frame first. Stacks are stored
+    as a tree of frames shared by common callers, and a stack id is the id of
+    its innermost frame. This matches the stackFrames table of Chrome's trace
+    format. Frame names are resolved once per frame by resolve(pc).
+    """
+    def __init__(self, resolve=None):
+        self.resolve = resolve if resolve is not None else lambda pc: '0x%x' % pc
+        self.stacks = {} # tuple of PCs -> stack id
+        self.frameIds = {} # (parent frame id, pc) -> frame id
+        self.frames = [] # frame id - 1 -> (parent frame id, pc, name)
+    def intern(self, pcs):
+        "return the id of the stack with PCs, adding it if needed"
+        if pcs in self.stacks:
+            return self.stacks[pcs]
+        parent = None
+        for pc in reversed(pcs):
+            key = (parent, pc)
+            if key not in self.frameIds:
+                self.frames.append((parent, pc, self.resolve(pc)))
+                self.frameIds[key] = len(self.frames)
+            parent = self.frameIds[key]
+        self.stacks[pcs] = parent
+        return parent
+    def frame(self, frameId):
+        "(parent frame id, pc, name) of frameId"
+        return self.frames[frameId - 1]
+    def names(self, stackId):
+        "frame names of a stack, innermost frame first"
+        names = []
+        while stackId is not None:
+            stackId, _pc, name = self.frame(stackId)
+            names.append(name)
+        return names
+    def numFrames(self):
+        "number of distinct frames"
+        return len(self.frames)
+
+
+class SPClock(object):
+    """clock for timestamping events excluding the collector's own overhead
+
+    In all-stop mode the whole program is stopped while a breakpoint handler
+    runs. The measured time spent in handlers is accumulated and subtracted
+    from the timestamps, and so is stopCost per stop for the trap, the
+    context switches and GDB's own work, which the handlers cannot measure.
+    stopCost is calibrated by the collector at the start; the corrected
+    times are as good as that estimate. In non-stop mode only the thread
+    hitting the breakpoint waits for the handler while the others run on,
+    so there is no common overhead to subtract and the timestamps are the
+    raw clock.
+    """
+    def __init__(self, allStop=True, stopCost=0.0):
+        self.allStop = allStop
+        self.stopCost = stopCost # seconds per stop outside the handlers
+        self.overhead = 0.0
+        self.entered = None
+        self.left = None # end of the last handler
+    def enter(self):
+        "start of a handler; return the corrected timestamp in seconds"
+        self.entered = clock()
+        if self.allStop and self.left is not None:
+            # an overestimated cost must not turn the time back
+            self.overhead += min(self.stopCost, self.entered - self.left)
+        return self.entered - self.overhead
+    def leave(self):
+        "end of a handler; account its duration as overhead"
+        if self.entered is not None and self.allStop:
+            self.left = clock()
+            self.overhead += self.left - self.entered
+        self.entered = None
+
+
+class SPHistogram(object):
+    """fixed-size histogram of non-negative durations in power of 2 buckets
+
+    Bucket 0 counts the values below 1, bucket i the values in [2^(i-1), 2^i).
+    Percentiles are upper bucket bounds, so they overestimate by at most 2x,
+    but the histogram takes the same memory for hours of events as for one.
+    """
+    __slots__ = ['buckets', 'count', 'total', 'max']
+    numBuckets = 64
+    def __init__(self):
+        self.buckets = [0] * self.numBuckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+    def add(self, value):
+        "count a value"
+        value = max(value, 0)
+        self.buckets[min(int(value).bit_length(), self.numBuckets - 1)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+    def percentile(self, p):
+        "upper bound of the p-th percentile (0-100), at most the maximum"
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n > 0 and seen >= rank:
+                return min(1 << i, self.max)
+        return self.max
+    def summary(self):
+        "dict of the count, total, percentiles and maximum"
+        return {'count': self.count,
+                'total': self.total,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+
+# lock functions -> (unlock function, kind of lock, hold mode)
+LOCK_FUNCTIONS = {}
+for _name in ['pthread_mutex_lock', 'pthread_mutex_trylock', 'pthread_mutex_timedlock']:
+    LOCK_FUNCTIONS[_name] = ('pthread_mutex_unlock', 'mutex', 'exclusive')
+for _name in ['pthread_rwlock_rdlock', 'pthread_rwlock_tryrdlock',
+              'pthread_rwlock_timedrdlock']:
+    LOCK_FUNCTIONS[_name] = ('pthread_rwlock_unlock', 'rwlock', 'shared')
+for _name in ['pthread_rwlock_wrlock', 'pthread_rwlock_trywrlock',
+              'pthread_rwlock_timedwrlock']:
+    LOCK_FUNCTIONS[_name] = ('pthread_rwlock_unlock', 'rwlock', 'exclusive')
+for _name in ['pthread_spin_lock', 'pthread_spin_trylock']:
+    LOCK_FUNCTIONS[_name] = ('pthread_spin_unlock', 'spinlock', 'exclusive')
+# unlock function -> lock functions waiting for it, i.e. without the trylocks
+BLOCKING_LOCKS = {}
+for _name, (_unlock, _kind, _mode) in sorted(LOCK_FUNCTIONS.items()):
+    BLOCKING_LOCKS.setdefault(_unlock, [])
+    if 'try' not in _name:
+        BLOCKING_LOCKS[_unlock].append(_name)
+
+
+# blocking functions -> synchronization primitive they wait for
+BLOCKING_FUNCTIONS = {}
+for _unlock, _names in BLOCKING_LOCKS.items():
+    for _name in _names:
+        BLOCKING_FUNCTIONS[_name] = LOCK_FUNCTIONS[_name][1]
+for _names, _primitive in [(['sem_wait', 'sem_timedwait'], 'semaphore'),
+                           (['pthread_cond_wait', 'pthread_cond_timedwait'], 'condvar'),
+                           (['pthread_join', 'pthread_timedjoin_np'], 'join'),
+                           (['pthread_barrier_wait'], 'barrier'),
+                           (['GOMP_barrier', 'GOMP_barrier_cancel', 'GOMP_critical_start',
+                             'GOMP_critical_name_start', 'GOMP_atomic_start',
+                             'GOMP_ordered_start', 'GOMP_loop_end', 'GOMP_loop_end_cancel',
+                             'GOMP_sections_end', 'GOMP_sections_end_cancel',
+                             'GOMP_parallel_end'], 'OpenMP')]:
+    for _name in _names:
+        BLOCKING_FUNCTIONS[_name] = _primitive
+
+
+class SPBlockedThreads(object):
+    """threads blocked in synchronization calls
+
+    A thread is blocked by the primitive of its outermost pending call of
+    BLOCKING_FUNCTIONS, from the start to the end of the call. Calls nested
+    in it, like the mutex lock at the end of a condition wait, do not count.
+    """
+    __slots__ = ['blocking', 'counts']
+    def __init__(self):
+        self.blocking = {} # thread -> outermost pending blocking call
+        self.counts = {} # primitive -> number of threads blocked by it
+    def update(self, event):
+        "account a status change of event; True if a thread got blocked or unblocked"
+        primitive = BLOCKING_FUNCTIONS.get(event.evName)
+        if primitive is None:
+            return False
+        if event.status == 'started':
+            if event.evThread in self.blocking:
+                return False
+            self.blocking[event.evThread] = event
+            self.counts[primitive] = self.counts.get(primitive, 0) + 1
+            return True
+        if self.blocking.get(event.evThread) is not event:
+            return False
+        del self.blocking[event.evThread]
+        self.counts[primitive] -= 1
+        return True
+
+
+def lockFailed(event):
+    "True if the lock function of a finished event returned an error, e.g. a trylock"
+    # the pthread functions return an int, so the upper bits of the register are ignored
+    return isinstance(event.evValue, numbers.Integral) and event.evValue & 0xffffffff != 0
+
+
+def returnedTrue(event):
+    "True if a function returning bool, e.g. GOMP_loop_*_next, returned true"
+    # only the low byte of the register holds a bool, the upper bits are garbage
+    return isinstance(event.evValue, numbers.Integral) and event.evValue & 0xff != 0
+
+
+# per-function recording policies in the config file
+POLICY_KEYS = ['max', 'every', 'on', 'off']
+
+
+def parseConfigLine(line):
+    """parse a config file line into (function, policy) or None if empty
+
+    A line holds a function name followed by optional policies:
+
+    - max=N: record at most N calls
+    - every=K: record 1 of every K calls
+    - on=T off=P: record for T ms, then pause for P ms, repeatedly
+
+    Text after # is a comment.
+    """
+    fields = line.split('#', 1)[0].split()
+    if not fields:
+        return None
+    policy = {}
+    for field in fields[1:]:
+        key, _sep, value = field.partition('=')
+        assert key in POLICY_KEYS and value.isdigit() and int(value) > 0, \
+            'invalid policy "%s" for %s' % (field, fields[0])
+        policy[key] = int(value)
+    assert ('on' in policy) == ('off' in policy), \
+        'policies on and off must be given together for %s' % fields[0]
+    return fields[0], policy
 
 
 def setupLogging(logLevel):
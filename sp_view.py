@@ -6,26 +6,52 @@ Printers for the sync-prof events
 """
 
 
+import collections
 import json
+import zlib
+from xml.sax.saxutils import escape
 
+from sp_util import BLOCKING_FUNCTIONS, SPBlockedThreads, SPHistogram, SPStack
 
-def sp_view(outFile, outFormat):
+
+# size of the output file buffers
+BUFFER_SIZE = 1 << 16
+# objects and threads summarized separately at most; the rest count as (other)
+SUMMARY_ROWS = 10000
+# number of events kept by the flight recorder by default
+FLIGHT_EVENTS = 10000
+
+
+def sp_view(outFile, outFormat, timing=False, stacks=None):
     "View factory"
     if outFormat == 'text':
-        return SPViewText(outFile)
+        return SPViewText(outFile, timing, stacks)
+    elif outFormat == 'compact':
+        return SPViewCompact(outFile, timing, stacks)
+    elif outFormat == 'flamegraph':
+        return SPViewFlameGraph(outFile, timing, stacks)
+    elif outFormat == 'summary':
+        return SPViewSummary(outFile, timing, stacks)
+    elif outFormat == 'flight':
+        return SPViewFlight(outFile, timing, stacks)
     else:
-        return SPViewChrome(outFile)
+        return SPViewChrome(outFile, timing, stacks)
 
 
 class SPView(object):
     "synchronization profile printer"
-    def __init__(self, outFileName):
+    def __init__(self, outFileName, timing=False, stacks=None):
         self.outFileName = outFileName
-        self.outFile = open(outFileName, 'w')
+        self.timing = timing # times are in microseconds
+        self.stacks = stacks # SPStackTable of the event backtraces
+        self.outFile = open(outFileName, 'w', BUFFER_SIZE)
     def __del__(self):
-        "print summary of synchronization events"
-        self.outFile.flush()
-        self.outFile.close()
+        self.close()
+    def close(self):
+        "flush and close the output file; safe to call more than once"
+        if not self.outFile.closed:
+            self.outFile.flush()
+            self.outFile.close()
     def link(self, category, name, startTime, startThread, stopTime, stopThread, args):
         pass
     def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
@@ -34,12 +60,34 @@ class SPView(object):
         pass
 
 
+class SPViewTee(object):
+    "pass the model's view calls on to several views, e.g. a view and analyses"
+    def __init__(self, views):
+        self.views = views
+    def close(self):
+        for view in self.views:
+            view.close()
+    def timestamp(self, pendEvents, event=None):
+        for view in self.views:
+            view.timestamp(pendEvents, event)
+    def link(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        for view in self.views:
+            view.link(category, name, startTime, startThread, stopTime, stopThread, args)
+    def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        for view in self.views:
+            view.group(category, name, startTime, startThread, stopTime, stopThread, args)
+    def mark(self, name, category, scope, time, thread):
+        for view in self.views:
+            view.mark(name, category, scope, time, thread)
+
+
 class SPViewText(SPView):
     "synchronization profile text printer"
-    def __init__(self, outFileName):
+    def __init__(self, outFileName, timing=False, stacks=None):
         self.indent = 40
-        super(SPViewText, self).__init__(outFileName)
-    def timestamp(self, pendEvents):
+        super(SPViewText, self).__init__(outFileName, timing, stacks)
+    def timestamp(self, pendEvents, event=None):
+        "print a line with a column per thread"
         syncString = ''
         threadsSorted = sorted([t for t in pendEvents])
         for thread in threadsSorted:
@@ -65,13 +113,17 @@ class SPViewText(SPView):
                     s = oldWaitingBPs + str(topEvent)
                 elif topEvent.status == 'finished': # just finished
                     s = '│ ' * (numThreadEvents - 1)
+                    if self.timing:
+                        # duration of the event under its last wait line
+                        s += '%dus' % (topEvent.stopTime - topEvent.startTime)
                 elif topEvent.status == 'waiting': # waiting:
                     s = '│ ' * numThreadEvents
                 else:
                     assert False, 'unknown event status %s of event %s' % \
                         (topEvent.status, topEvent)
             # grow the indentation if necessary
-            sWidth = len(s.decode('utf-8'))
+            # Python 2 strings hold UTF-8 bytes; count characters instead
+            sWidth = len(s.decode('utf-8')) if isinstance(s, bytes) else len(s)
             emptyColumns = self.indent - sWidth
             if emptyColumns <= 0:
                 # extend the width of each thread column including a slack of 5
@@ -91,79 +143,242 @@ class SPViewText(SPView):
         self.outFile.write(markStr + '\n')
 
 
+class SPViewCompact(SPView):
+    """synchronization profile printer with a line per event change
+
+    The text view writes a column for every thread on every event, which
+    gets slow and huge with many threads. This view writes tab-separated
+    lines of the model time, thread, stack depth, change and event instead:
+
+    - started/finished/aborted: the event on top of the thread's stack
+    - mark: an instant annotation
+
+    "sync-prof pager" renders the columns of the text view from it for
+    selected threads.
+    """
+    chunkSize = 1000
+
+    def __init__(self, outFileName, timing=False, stacks=None):
+        self.lines = []
+        super(SPViewCompact, self).__init__(outFileName, timing, stacks)
+
+    def close(self):
+        "write the remaining lines"
+        if not self.outFile.closed:
+            self.flush()
+        super(SPViewCompact, self).close()
+
+    def flush(self):
+        "append buffered lines to the output file"
+        self.outFile.write(''.join(self.lines))
+        self.lines = []
+
+    def write(self, time, thread, depth, change, text):
+        "buffer a line"
+        self.lines.append('%d\t%s\t%d\t%s\t%s\n' % (time, thread, depth, change, text))
+        if len(self.lines) >= self.chunkSize:
+            self.flush()
+
+    def timestamp(self, pendEvents, event=None):
+        "write the status change of event"
+        depth = pendEvents[event.evThread]['events'].size()
+        if event.status == 'started':
+            self.write(event.startTime, event.evThread, depth, 'started', str(event))
+        else:
+            assert event.status in ['finished', 'aborted'], \
+                'unexpected status %s of event %s' % (event.status, event)
+            self.write(event.stopTime, event.evThread, depth, event.status, str(event))
+
+    def mark(self, name, category, scope, time, thread):
+        self.write(time, thread, 0, 'mark', '%s: %s (scope %s, thread %s)' % (category,
+                                                                              name,
+                                                                              scope,
+                                                                              thread))
+
+
+class SPPagedEvent(object):
+    "event read back from the compact view for the text view"
+    def __init__(self, text, startTime):
+        self.text = text
+        self.startTime = startTime
+        self.stopTime = None
+        self.status = 'started'
+    def __str__(self):
+        return self.text
+
+
+def page(compactFile, outFileName, threads=None, timing=False):
+    """render the output of SPViewCompact as columns of the text view
+
+    Only the columns of threads are rendered, all threads if None.
+    """
+    view = SPViewText(outFileName, timing)
+    pendEvents = {}
+    with open(compactFile, 'r') as f:
+        for line in f:
+            time, thread, _depth, change, text = line.rstrip('\n').split('\t', 4)
+            time = int(time)
+            if change == 'mark':
+                view.outFile.write(text + '\n')
+                continue
+            thread = int(thread)
+            if threads is not None and thread not in threads:
+                continue
+            events = pendEvents.setdefault(thread, {'events': SPStack()})['events']
+            if change == 'started':
+                event = SPPagedEvent(text, time)
+                events.push(event)
+                view.timestamp(pendEvents)
+                event.status = 'waiting'
+            else:
+                event = events.top()
+                event.status = change
+                event.stopTime = time
+                view.timestamp(pendEvents)
+                events.pop()
+    view.close()
+
+
 class SPViewChrome(SPView):
-    "synchronization profile printer in the JSON format for Chrome's trace viewer"
-    def __init__(self, outFileName):
-        self.events = []
+    """synchronization profile printer in the JSON format for Chrome's trace viewer
+
+    Events are streamed to the output file in chunks of chunkSize events.
+    After each chunk the closing brackets of the JSON document are written and
+    the file position is rewound to overwrite them with the next chunk. Thus,
+    the file on disk is a valid trace even if the collector dies. The table of
+    stack frames grows during the whole run, so it is written only at the end.
+    """
+    chunkSize = 1000
+
+    def __init__(self, outFileName, timing=False, stacks=None):
+        self.chunk = []
+        self.numEvents = 0
         self.jsonSliceId = 0
-        super(SPViewChrome, self).__init__(outFileName)
+        self.blocked = SPBlockedThreads()
+        super(SPViewChrome, self).__init__(outFileName, timing, stacks)
+        self.outFile.write('{"traceEvents": [')
+        self.flush()
 
-    def __del__(self):
-        # TODO: refactor for streaming instead of growing memory
-        # and flushing all at once at the end
-        self.events = {'traceEvents': self.events}
-        json.dump(self.events, open(self.outFileName, 'w'))
-        super(SPViewChrome, self).__del__()
-
-    def timestamp(self, pendEvents):
-        for threadDict in pendEvents.values():
-            eventStack = threadDict['events']
-            if not eventStack.empty():
-                event = eventStack.top()
-                if event.status in ['finished', 'aborted']:
-                    args = {'argument1' : event.evArg1,
-                            'argument2' : event.evArg2,
-                            'value' : event.evValue,
-                            'source' : event.evFilename,
-                            'line' : event.evLine,
-                            'stacktrace' : event.evBacktrace}
-                    if event.evType == 'access':
-                        category = 'access'
+    def close(self):
+        "write the remaining events and terminate the JSON document"
+        if not self.outFile.closed:
+            self.flush(final=True)
+        super(SPViewChrome, self).close()
+
+    def flush(self, final=False):
+        "append buffered events to the output file"
+        for e in self.chunk:
+            separator = ',\n' if self.numEvents > 0 else '\n'
+            self.outFile.write(separator + json.dumps(e))
+            self.numEvents += 1
+        self.chunk = []
+        trailerPos = self.outFile.tell()
+        self.outFile.write(self.trailer(final))
+        if final:
+            self.outFile.truncate()
+        else:
+            self.outFile.flush()
+            # the next chunk overwrites the trailer
+            self.outFile.seek(trailerPos)
+
+    def trailer(self, final):
+        "closing part of the JSON document, with the stack frames if final"
+        numFrames = 0 if self.stacks is None else self.stacks.numFrames()
+        if not final or numFrames == 0:
+            return '\n]}\n'
+        stackFrames = {}
+        for frameId in range(1, numFrames + 1):
+            parent, _pc, name = self.stacks.frame(frameId)
+            frame = {'name': name, 'category': 'sync-prof'}
+            if parent is not None:
+                frame['parent'] = str(parent)
+            stackFrames[str(frameId)] = frame
+        return '\n],\n"stackFrames": %s}\n' % json.dumps(stackFrames)
+
+    def emit(self, events):
+        "buffer JSON events and stream them out in chunks"
+        self.chunk += events
+        if len(self.chunk) >= self.chunkSize:
+            self.flush()
+
+    def timestamp(self, pendEvents, event=None):
+        """emit the slices of the finished events on top of the threads' stacks
+
+        If event is given, it is the only event that changed its status.
+        Blocking calls also update the counter of the blocked threads per
+        primitive.
+        """
+        if event is not None:
+            if self.blocked.update(event):
+                self.counter(event)
+            topEvents = [event]
+        else:
+            topEvents = [threadDict['events'].top() for threadDict in pendEvents.values()
+                         if not threadDict['events'].empty()]
+        for event in topEvents:
+            if event.status in ['finished', 'aborted']:
+                args = {'argument1' : event.evArg1,
+                        'argument2' : event.evArg2,
+                        'value' : event.evValue,
+                        'source' : event.evFilename,
+                        'line' : event.evLine}
+                if event.evType == 'access':
+                    category = 'access'
+                else:
+                    # function breakpoint:
+                    # TODO: move to sp.conf
+                    if 'GOMP_' in event.evName:
+                        category = 'OpenMP'
+                    elif 'pthread_' in event.evName:
+                        category = 'POSIX threads'
+                    elif 'sem_' in event.evName:
+                        category = 'POSIX semaphores'
                     else:
-                        # function breakpoint:
-                        # TODO: move to sp.conf
-                        if 'GOMP_' in event.evName:
-                            category = 'OpenMP'
-                        elif 'pthread_' in event.evName:
-                            category = 'POSIX threads'
-                        elif 'sem_' in event.evName:
-                            category = 'POSIX semaphores'
-                        else:
-                            category = 'unknown'
-                    self.events += self.jsonSlice(category,
-                                                  event.evThread,
-                                                  event.evThread,
-                                                  event.evName,
-                                                  event.startTime,
-                                                  event.stopTime,
-                                                  args)
+                        category = 'unknown'
+                jsonSlice = self.jsonSlice(category,
+                                           event.evThread,
+                                           event.evThread,
+                                           event.evName,
+                                           event.startTime,
+                                           event.stopTime,
+                                           args)
+                if event.evBacktrace is not None:
+                    # reference to the stackFrames table
+                    jsonSlice[0]['sf'] = event.evBacktrace
+                self.emit(jsonSlice)
 
     def link(self, category, name, startTime, startThread, stopTime, stopThread, args):
         "arrow in the timeline"
-        self.events += self.jsonSlice(category,
-                                      startThread,
-                                      stopThread,
-                                      name,
-                                      startTime,
-                                      stopTime,
-                                      args,
-                                      depSlice=True)
+        self.emit(self.jsonSlice(category,
+                                 startThread,
+                                 stopThread,
+                                 name,
+                                 startTime,
+                                 stopTime,
+                                 args,
+                                 depSlice=True))
 
     def group(self, category, name, startTime, startThread, stopTime, stopThread, args):
         "slices for designating groups of elementary slices"
-        self.events += self.jsonSlice(category,
-                                      startThread,
-                                      stopThread,
-                                      name,
-                                      startTime,
-                                      stopTime,
-                                      args)
+        self.emit(self.jsonSlice(category,
+                                 startThread,
+                                 stopThread,
+                                 name,
+                                 startTime,
+                                 stopTime,
+                                 args))
+
+    def counter(self, event):
+        "number of blocked threads per primitive after event started or ended"
+        time = event.startTime if event.status == 'started' else event.stopTime
+        self.emit([{'cat': 'synchronization flow', 'name': 'blocked threads', 'pid': 1,
+                    'ph': 'C', 'ts': time, 'args': dict(self.blocked.counts)}])
 
     def mark(self, name, category, scope, time, thread):
         "print instant event in the timeline"
         scope = {'global': 'g', 'process': 'p', 'thread': 't'}[scope]
         self.jsonSliceId += 1
-        self.events += [self.event(name, category, thread, 'I', time, {}, scope)]
+        self.emit([self.event(name, category, thread, 'I', time, {}, scope)])
 
     def jsonSlice(self,
                   category,
@@ -194,3 +409,271 @@ class SPViewChrome(SPView):
         if scope is not None:
             e['s'] = scope
         return e
+
+
+class SPViewFlameGraph(SPView):
+    """wait time of the blocking calls by call stack as a flame graph
+
+    The output file holds the stacks in the folded format of flame graph
+    tools: a line per stack with its frames from the outermost one,
+    separated by semicolons, and its total. A self-contained SVG flame graph
+    of the stacks is written to the output file name with .html appended.
+    With native timing, the totals are wait times in microseconds, otherwise
+    numbers of calls. Only the outermost blocking call of a thread counts,
+    as in the blocked threads counter of the Chrome view.
+    """
+    width = 1200
+    frameHeight = 16
+    charWidth = 7 # of the frame labels in pixels
+
+    def __init__(self, outFileName, timing=False, stacks=None):
+        self.blocked = SPBlockedThreads()
+        self.folded = {} # tuple of frame names from the outermost one -> total
+        super(SPViewFlameGraph, self).__init__(outFileName, timing, stacks)
+
+    def close(self):
+        "write the folded stacks and the HTML flame graph"
+        if not self.outFile.closed:
+            for stack, total in sorted(self.folded.items()):
+                self.outFile.write('%s %d\n' % (';'.join(stack), total))
+            with open(self.outFileName + '.html', 'w') as f:
+                f.write(self.html())
+        super(SPViewFlameGraph, self).close()
+
+    def timestamp(self, pendEvents, event=None):
+        "add the finished blocking calls to their stacks"
+        if event is None or not self.blocked.update(event) or event.status == 'started':
+            return
+        names = []
+        if event.evBacktrace is not None and self.stacks is not None:
+            names = self.stacks.names(event.evBacktrace)
+        if not names or event.evName not in names[0]:
+            # stacks of the preload collector start in the caller
+            names = [event.evName] + names
+        stack = tuple(name.replace(';', ':') for name in reversed(names))
+        total = event.stopTime - event.startTime if self.timing else 1
+        if total > 0:
+            self.folded[stack] = self.folded.get(stack, 0) + total
+
+    def html(self):
+        "HTML page with the flame graph of the folded stacks as SVG"
+        root = [0, {}] # total, children by name
+        for stack, total in self.folded.items():
+            node = root
+            node[0] += total
+            for name in stack:
+                node = node[1].setdefault(name, [0, {}])
+                node[0] += total
+        rects = []
+        self.layout('all', root, 0, 0, rects)
+        depth = max([r[1] for r in rects] + [0]) + 1
+        height = depth * self.frameHeight
+        unit = 'us' if self.timing else 'calls'
+        svg = []
+        for name, level, x, width, total in rects:
+            y = height - (level + 1) * self.frameHeight
+            label = name[:int(width / self.charWidth)] if width > 3 * self.charWidth else ''
+            svg.append('<g><title>%s (%d %s, %.1f%%)</title>'
+                       '<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s"/>'
+                       '<text x="%.1f" y="%d">%s</text></g>' % \
+                           (escape(name), total, unit, 100.0 * total / max(root[0], 1),
+                            x, y, width, self.frameHeight - 1, self.color(name),
+                            x + 3, y + self.frameHeight - 4, escape(label)))
+        return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                '<title>sync-prof wait flame graph</title><style>'
+                'body {font-family: sans-serif} rect {stroke: white; stroke-width: 0.5} '
+                'text {font-size: 11px; font-family: monospace; pointer-events: none}'
+                '</style></head><body>\n<h3>Blocked in synchronization: %d %s</h3>\n'
+                '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">\n%s\n'
+                '</svg></body></html>\n') % (root[0], unit, self.width, height, '\n'.join(svg))
+
+    def layout(self, name, node, level, x, rects):
+        "append the rectangles of node and its children as (name, level, x, width, total)"
+        total, children = node
+        if total <= 0:
+            return
+        scale = float(self.width) / max(rects[0][4] if rects else total, 1)
+        width = total * scale
+        if width < 0.1:
+            return
+        rects.append((name, level, x, width, total))
+        for childName in sorted(children):
+            child = children[childName]
+            self.layout(childName, child, level + 1, x, rects)
+            x += child[0] * scale
+
+    @staticmethod
+    def color(name):
+        "warm color derived from the frame name"
+        v = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+        return 'rgb(%d,%d,%d)' % (205 + v % 50, (v // 50) % 230, (v // 11500) % 55)
+
+
+class SPCallStat(object):
+    "number and durations of calls"
+    __slots__ = ['calls', 'aborted', 'time']
+    def __init__(self):
+        self.calls = 0
+        self.aborted = 0 # calls that never returned, e.g. in a deadlock
+        self.time = SPHistogram()
+    def add(self, event):
+        "count a finished or aborted event"
+        if event.status == 'finished':
+            self.calls += 1
+            self.time.add(event.stopTime - event.startTime)
+        else:
+            self.aborted += 1
+
+
+class SPViewSummary(SPView):
+    """calls and their durations per function, object and thread
+
+    Nothing is written per event. The view keeps a fixed-size SPCallStat
+    per function, per synchronization object (e.g. a mutex) and per thread,
+    and writes their tables to the output file when it is closed. Threads
+    count their outermost blocking calls as their blocked time. Beyond
+    SUMMARY_ROWS objects or threads, the rest are added up as (other), so
+    the memory stays bounded on long runs.
+    """
+    objectPrimitives = ['mutex', 'rwlock', 'spinlock', 'semaphore', 'condvar', 'barrier']
+
+    def __init__(self, outFileName, timing=False, stacks=None):
+        self.functions = {} # function -> SPCallStat
+        self.objects = {} # (primitive, object) -> SPCallStat
+        self.threads = {} # thread -> SPCallStat of the outermost blocking calls
+        super(SPViewSummary, self).__init__(outFileName, timing, stacks)
+
+    def close(self):
+        "write the tables"
+        if not self.outFile.closed:
+            unit = 'us' if self.timing else 'steps'
+            self.table('Calls per function (times in %s):' % unit, 'function',
+                       [((name,), stat) for name, stat in self.functions.items()])
+            self.table('Waits per object (times in %s):' % unit, 'object',
+                       [((str(obj), primitive), stat)
+                        for (primitive, obj), stat in self.objects.items()])
+            self.table('Blocked time per thread (times in %s):' % unit, 'thread',
+                       [((str(thread),), stat) for thread, stat in self.threads.items()])
+        super(SPViewSummary, self).close()
+
+    def table(self, title, column, rows):
+        "write rows of (names, SPCallStat) with the longest total time first"
+        if not rows:
+            return
+        rows.sort(key=lambda r: (-r[1].time.total, -r[1].calls, r[0]))
+        extra = '{:<12}' if len(rows[0][0]) > 1 else ''
+        row = '{:<40}' + extra + '{:>10}{:>8}{:>12}{:>10}{:>10}{:>10}\n'
+        self.outFile.write('\n%s\n' % title)
+        header = [column, 'primitive'][:len(rows[0][0])]
+        self.outFile.write(row.format(*header + ['calls', 'aborted', 'time', 'p50',
+                                                 'p99', 'max']))
+        for names, stat in rows:
+            summary = stat.time.summary()
+            self.outFile.write(row.format(*list(names) + [stat.calls, stat.aborted,
+                                                          summary['total'], summary['p50'],
+                                                          summary['p99'], summary['max']]))
+
+    def timestamp(self, pendEvents, event=None):
+        "add up the returned and aborted calls"
+        if event is None or event.status == 'started':
+            return
+        stat = self.functions.get(event.evName)
+        if stat is None:
+            stat = self.functions[event.evName] = SPCallStat()
+        stat.add(event)
+        primitive = BLOCKING_FUNCTIONS.get(event.evName)
+        if primitive is None:
+            return
+        if primitive in self.objectPrimitives:
+            self.stat(self.objects, (primitive, event.evArg1), (primitive, '(other)')).add(event)
+        # nested blocking calls, like the mutex lock ending a condition wait, do not count
+        for pendEvent in pendEvents[event.evThread]['events']:
+            if pendEvent is not event and pendEvent.evName in BLOCKING_FUNCTIONS:
+                return
+        self.stat(self.threads, event.evThread, '(other)').add(event)
+
+    @staticmethod
+    def stat(stats, key, otherKey):
+        "SPCallStat of key in stats, or of otherKey if stats are full"
+        stat = stats.get(key)
+        if stat is None:
+            if len(stats) >= SUMMARY_ROWS:
+                key = otherKey
+                stat = stats.get(key)
+            if stat is None:
+                stat = stats[key] = SPCallStat()
+        return stat
+
+
+class SPViewFlight(SPView):
+    """flight recorder keeping only the most recent events
+
+    Nothing is written per event. The last status changes, links and marks
+    are kept in a ring of fixed size as lines of the compact view. dump()
+    writes the ring and the pending calls and held locks of every thread to
+    the output file, e.g. when the program hangs.
+    """
+    def __init__(self, outFileName, timing=False, stacks=None, events=FLIGHT_EVENTS):
+        self.ring = collections.deque(maxlen=events) # (time, thread, depth, change, text)
+        self.recorded = 0
+        self.dumps = 0
+        self.dumped = None # number of records at the last dump
+        super(SPViewFlight, self).__init__(outFileName, timing, stacks)
+
+    def timestamp(self, pendEvents, event=None):
+        "record the status change of event"
+        if event is None:
+            return
+        depth = pendEvents[event.evThread]['events'].size()
+        time = event.startTime if event.status == 'started' else event.stopTime
+        # the event is formatted only when it is dumped
+        self.ring.append((time, event.evThread, depth, event.status, event))
+        self.recorded += 1
+
+    def link(self, category, name, startTime, startThread, stopTime, stopThread, args):
+        "record a link"
+        objects = ' '.join(str(arg) for _name, arg in sorted(args.items()))
+        self.ring.append((startTime, startThread, 0, 'link',
+                          '%s %s to thread %s' % (name, objects, stopThread)))
+        self.recorded += 1
+
+    def mark(self, name, category, scope, time, thread):
+        "record a mark"
+        self.ring.append((time, thread, 0, 'mark', '%s: %s' % (category, name)))
+        self.recorded += 1
+
+    def dump(self, reason, pendEvents, time):
+        """write the ring and the pending calls and held locks per thread
+
+        Return False without writing if nothing was recorded since the last
+        dump.
+        """
+        if self.outFile.closed or self.dumped == self.recorded:
+            return False
+        self.dumps += 1
+        self.dumped = self.recorded
+        unit = 'us' if self.timing else 'steps'
+        out = self.outFile
+        out.write('# flight recorder dump %d at time %d %s: %s\n' % \
+                      (self.dumps, time, unit, reason))
+        out.write('# last %d of %d events: time, thread, depth, change, event\n' % \
+                      (len(self.ring), self.recorded))
+        for record in self.ring:
+            out.write('%d\t%s\t%d\t%s\t%s\n' % record)
+        out.write('# pending calls, innermost first, and held locks per thread\n')
+        for thread in sorted(pendEvents):
+            threadDict = pendEvents[thread]
+            if threadDict['events'].empty() and threadDict['locks'].empty():
+                continue
+            out.write('thread %s:\n' % thread)
+            for event in threadDict['events']:
+                out.write('  %s %s since %d\n' % (event.status, event, event.startTime))
+                if event.evBacktrace is not None and self.stacks is not None:
+                    for name in self.stacks.names(event.evBacktrace):
+                        out.write('    at %s\n' % name)
+            for lock in threadDict['locks']:
+                out.write('  holds %s since %d (%s)\n' % (lock.evArg1, lock.stopTime,
+                                                           lock.evName))
+        out.write('\n')
+        out.flush()
+        return True
@@ -0,0 +1,91 @@
+# Overhead benchmark of the sync-prof collectors
+#
+# Runs the terminating test programs natively and under each collector and
+# prints the wall-clock time per run, the best of several repetitions:
+#
+#   $ cd test && python bench_overhead.py [--repeat N] [PROGRAM.c ...]
+
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# programs that never end by design
+HANGING = ['deadlock_mutex.c', 'deadlock_sem.c', 'livelock.c']
+
+# column -> sync-prof options; None runs the program natively
+MODES = [('native', None),
+         ('gdb', ['--collector', 'gdb']),
+         ('gdb non-stop', ['--collector', 'gdb', '--non-stop']),
+         ('preload', ['--collector', 'preload'])]
+
+# seconds after which a run is abandoned
+TIMEOUT = 120
+
+
+def compileProg(src, binary):
+    "build a test program with the flags of the smoke tests"
+    flags = ['-fopenmp'] if src.startswith('openmp') else ['-pthread']
+    subprocess.check_call(['cc', '-g', '-o', binary, src] + flags)
+
+
+def timeRun(cmd):
+    "seconds cmd takes, or None if it fails or times out"
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        status = subprocess.call(['timeout', '%ds' % TIMEOUT] + cmd,
+                                 stdout=devnull, stderr=devnull)
+        elapsed = time.time() - start
+    return elapsed if status == 0 else None
+
+
+def bench(src, repeat, profile):
+    "best time per mode for src, formatted for the table"
+    fd, binary = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        compileProg(src, binary)
+        times = []
+        for _name, options in MODES:
+            if options is not None and 'gdb' in options and shutil.which('gdb') is None:
+                times.append('no gdb')
+                continue
+            cmd = [binary]
+            if options is not None:
+                cmd = [sys.executable, '../sync-prof', '-o', profile] + options + cmd
+            runs = [timeRun(cmd) for _i in range(repeat)]
+            runs = [t for t in runs if t is not None]
+            times.append('%.3f' % min(runs) if runs else 'failed')
+        return times
+    finally:
+        os.remove(binary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time the test programs under sync-prof')
+    parser.add_argument('programs', metavar='PROGRAM.c', nargs='*',
+                        help='sources to run, default all terminating test programs')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help='runs per program and mode, default 3')
+    args = parser.parse_args()
+    programs = args.programs or sorted(f for f in os.listdir('.')
+                                       if f.endswith('.c') and f not in HANGING)
+    fd, profile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        print('{:<24}'.format('seconds') + ''.join('{:>14}'.format(name)
+                                                   for name, _options in MODES))
+        for src in programs:
+            times = bench(src, args.repeat, profile)
+            print('{:<24}'.format(src) + ''.join('{:>14}'.format(t) for t in times))
+    finally:
+        os.remove(profile)
+
+
+if __name__ == '__main__':
+    main()
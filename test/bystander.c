@@ -0,0 +1,45 @@
+/// DESC: A thread computing without synchronization next to a thread locking in a loop.
+
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#define WORK 20000000
+
+pthread_mutex_t busy = PTHREAD_MUTEX_INITIALIZER;
+pthread_mutex_t done = PTHREAD_MUTEX_INITIALIZER;
+volatile uint64_t sum = 0;
+
+void* run_locker(void* ignored)
+{
+  for (;;)
+  {
+    pthread_mutex_lock(&busy);
+    pthread_mutex_unlock(&busy);
+  }
+  return NULL;
+}
+
+void* run_bystander(void* ignored)
+{
+  uint64_t i;
+  for (i = 0; i < WORK; i++)
+  {
+    sum += i;
+  }
+  /* traced only if the work ends in time */
+  pthread_mutex_lock(&done);
+  pthread_mutex_unlock(&done);
+  return NULL;
+}
+
+int main(void)
+{
+  pthread_t locker, bystander;
+  pthread_create(&locker, NULL, run_locker, NULL);
+  pthread_create(&bystander, NULL, run_bystander, NULL);
+  pthread_join(bystander, NULL);
+  printf("sum = %llu\n", (unsigned long long) sum);
+  return EXIT_SUCCESS;
+}
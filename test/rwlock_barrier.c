@@ -0,0 +1,71 @@
+/// DESC: Readers and a writer sharing a reader/writer lock, a spinlock guarded counter and a barrier.
+
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+
+#define READERS 3
+#define READS 20
+
+int32_t value = 0;
+
+pthread_rwlock_t rw = PTHREAD_RWLOCK_INITIALIZER;
+pthread_spinlock_t sl;
+pthread_barrier_t b;
+
+void* reader(void* arg)
+{
+  for (int i = 0; i < READS; i++)
+  {
+    pthread_rwlock_rdlock(&rw);
+    usleep(1000);
+    pthread_rwlock_unlock(&rw);
+    pthread_spin_lock(&sl);
+    value++;
+    pthread_spin_unlock(&sl);
+  }
+  // the last reader arrives late at the barrier
+  if ((intptr_t)arg == READERS - 1)
+  {
+    usleep(5000);
+  }
+  pthread_barrier_wait(&b);
+  return NULL;
+}
+
+void* writer(void* ignored)
+{
+  usleep(1000);
+  for (int i = 0; i < 3; i++)
+  {
+    pthread_rwlock_wrlock(&rw);
+    value++;
+    pthread_rwlock_unlock(&rw);
+    if (pthread_rwlock_trywrlock(&rw) == 0)
+    {
+      pthread_rwlock_unlock(&rw);
+    }
+  }
+  pthread_barrier_wait(&b);
+  return NULL;
+}
+
+int main(void)
+{
+  pthread_t threads[READERS + 1];
+  pthread_spin_init(&sl, PTHREAD_PROCESS_PRIVATE);
+  pthread_barrier_init(&b, NULL, READERS + 1);
+  for (intptr_t i = 0; i < READERS; i++)
+  {
+    pthread_create(&threads[i], NULL, reader, (void*)i);
+  }
+  pthread_create(&threads[READERS], NULL, writer, NULL);
+  for (int i = 0; i <= READERS; i++)
+  {
+    pthread_join(threads[i], NULL);
+  }
+  printf("value = %d\n", value);
+  return EXIT_SUCCESS;
+}
@@ -7,23 +7,32 @@ import tempfile
 import os
 import re
 import json
+import shutil
 
 
 class Prog(object):
     "describes program under test"
-    def __init__(self, src, compileOpts, outputType, expectedOutput):
+    def __init__(self, src, compileOpts, outputType, expectedOutput, options=[],
+                 absentOutput=[]):
         self.src = src
         self.compileOpts = compileOpts
         self.outputType = outputType
         self.expectedOutput = expectedOutput
+        self.options = options
+        self.absentOutput = absentOutput
     def __str__(self):
-        return str(self.src) + ' ' + self.outputType
+        return str(self.src) + ' ' + self.outputType + ' ' + ' '.join(self.options)
 
 
 # description of test cases
 # - the first two arguments define the sources and compiler flags
-# - the third argument in the constructor defines the type of the output (text or chrome)
-# - the last argument lists check conditions
+# - the third argument in the constructor defines the type of the output (text, chrome,
+#   raw, which is replayed into chrome, compact, which is paged into text, flamegraph,
+#   summary or flight)
+# - the fourth argument lists check conditions
+# - the optional fifth argument lists extra sync-prof options
+# - the optional last argument lists chrome events that must not be traced; their
+#   args may be a subset of the event's args
 testProgs = [
     Prog(['smoke_test_posix.c'],
          ['-pthread'],
@@ -48,6 +57,79 @@ testProgs = [
           {'name': 'thread started'},
           {'name': 'thread finished'},
           {'name': 'exit'}]),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'chrome',
+         [{'name': 'pthread_mutex_lock', 'cat': 'POSIX threads'},
+          {'name': 'locked by m'},
+          {'name': 'thread started'}],
+         ['--timing']),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'chrome',
+         [{'name': 'pthread_join', 'cat': 'POSIX threads', 'tid': 1},
+          {'name': 'pthread_mutex_lock', 'cat': 'POSIX threads'},
+          {'name': 'locked by m'},
+          {'name': 'lock released', 'cat': 'synchronization flow'},
+          {'name': 'thread finished'}],
+         ['--timing', '--non-stop']),
+    Prog(['bystander.c'],
+         ['-pthread'],
+         'chrome',
+         [{'name': 'pthread_mutex_lock', 'args': {'argument1': 'busy'}},
+          {'name': 'pthread_mutex_lock', 'args': {'argument1': 'done'}}],
+         ['--non-stop']),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'text',
+         [r'pthread_create\s+2',
+          r'pthread_mutex_lock\s+64\s+\(8 recorded\)',
+          r'pthread_mutex_unlock\s+64\s+\(5 recorded\)'],
+         ['--config', 'sampled.conf']),
+    Prog(['condvar.c'],
+         ['-pthread'],
+         'chrome',
+         [{'name': 'condition satisfied', 'args' : {'condition variable': 'cond_var'}},
+          {'name': 'pthread_mutex_lock'},
+          {'name': 'pthread_mutex_unlock'}],
+         ['--backtrace', 'pc:4']),
+    Prog(['condvar.c'],
+         ['-pthread'],
+         'text',
+         [r'Condition variables \(times in steps\):',
+          r'\ncond_var\s+1\s+1\s+0\s+0\s+'],
+         ['--analyses', 'condvars']),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'text',
+         [r'Lock contention \(times in us\):',
+          r'\nm\s+64\s+\d+\s+\d+',
+          r'Top contending call sites:\nm\s+\d+ calls\s+\d+ us thread_fun'],
+         ['--timing', '--analyses', 'locks']),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'summary',
+         [r'Calls per function \(times in steps\):',
+          r'\npthread_mutex_lock\s+64\s+0\s+',
+          r'\nm\s+mutex\s+64\s+0\s+']),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'flamegraph',
+         [r'thread_fun[^;\n]*;[^;\n]*pthread_mutex_lock[^;\n]* \d+\n',
+          r'main[^;\n]*;[^;\n]*pthread_join[^;\n]* \d+\n']),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'flamegraph',
+         # libc frames without debug info around the traced calls
+         [r'[^;\n]+;thread_fun at [^;\n]*smoke_test_posix\.c:\d+;[^;\n]*pthread_mutex_lock',
+          r'main at [^;\n]*smoke_test_posix\.c:\d+;[^;\n]*pthread_join'],
+         ['--backtrace', 'full']),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'compact',
+         [r'pthread_create \S+',
+          r'├─clone \S+',
+          r'\s+pthread_mutex_lock m']),
     Prog(['weird_thread_graph.c'],
          ['-pthread'],
          'chrome',
@@ -65,6 +147,18 @@ testProgs = [
           r'sem_init\s+5',
           r'sem_post\s+\d+\s+',
           r'sem_wait\s+\d+\s+']),
+    Prog(['semaphore-workers.c'],
+         ['-pthread'],
+         'text',
+         [r'Critical path: \d+ steps to the end of thread 1',
+          r'Waits on the critical path:'],
+         ['--analyses', 'critical-path']),
+    Prog(['semaphore-workers.c'],
+         ['-pthread'],
+         'text',
+         [r'Thread utilization \(times in steps, at most \d+ threads blocked\):',
+          r'\n1\s+\d+\s+\d+\s+\d+%\s+'],
+         ['--analyses', 'utilization']),
     Prog(['semaphore-workers.c'],
          ['-pthread'],
          'chrome',
@@ -72,7 +166,26 @@ testProgs = [
           {'name': 'sem_init'},
           {'name': 'sem_post'},
           {'name': 'sem_wait'},
-          {'name': 'semaphore increment'}]),
+          {'name': 'semaphore increment'},
+          {'name': 'blocked threads', 'ph': 'C'}]),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'raw',
+         [{'name': 'pthread_create', 'cat': 'POSIX threads', 'tid': 1},
+          {'name': 'pthread_mutex_lock', 'cat': 'POSIX threads'},
+          {'name': 'locked by m'},
+          {'name': 'thread started'},
+          {'name': 'thread finished'}]),
+    Prog(['smoke_test_posix.c'],
+         ['-pthread'],
+         'chrome',
+         [{'name': 'pthread_create', 'cat': 'POSIX threads', 'tid': 1},
+          {'name': 'pthread_join', 'cat': 'POSIX threads', 'tid': 1},
+          {'name': 'pthread_mutex_lock', 'cat': 'POSIX threads'},
+          {'name': 'locked by m'},
+          {'name': 'thread started'},
+          {'name': 'thread finished'}],
+         ['--collector', 'preload']),
     Prog(['openmp_matmul.c'],
          ['-fopenmp'],
          'text',
@@ -80,6 +193,12 @@ testProgs = [
           r'exit\s+1',
           r'GOMP_parallel_start\s+\d+\s+',
           r'GOMP_parallel_end\s+\d+\s+']),
+    Prog(['openmp_matmul.c'],
+         ['-fopenmp'],
+         'text',
+         [r'OpenMP parallel regions \(times in steps\):',
+          r'\n1\s+1\s+\d+\s+\d+'],
+         ['--analyses', 'openmp']),
     Prog(['openmp_matmul.c'],
          ['-fopenmp'],
          'chrome',
@@ -95,6 +214,21 @@ testProgs = [
           {'name': 'locked by m2'},
           {'name': 'pthread_mutex_lock'},
           {'name': 'pthread_mutex_lock'}]),
+    Prog(['deadlock_mutex.c'],
+         ['-pthread'],
+         'chrome',
+         [{'name': 'locked by m1'},
+          {'name': 'pthread_mutex_lock'}],
+         ['--only-objects', 'm1'],
+         [{'name': 'locked by m2'},
+          {'name': 'pthread_mutex_lock', 'args': {'argument1': 'm2'}}]),
+    Prog(['deadlock_mutex.c'],
+         ['-pthread'],
+         'flight',
+         [r'# flight recorder dump 1 at time \d+ steps: pthread_join called in thread 1',
+          r'\n\d+\t1\t1\tstarted\tpthread_join ',
+          r'\nthread 1:\n  started pthread_join \S+ since \d+\n'],
+         ['--trigger', 'pthread_join', '--backtrace', 'off']),
     Prog(['deadlock_sem.c'],
          ['-pthread'],
          'chrome',
@@ -118,7 +252,17 @@ testProgs = [
           {'name': 'pthread_mutex_unlock'},
           {'name': 'pthread_mutex_lock'},
           {'name': 'pthread_mutex_unlock'},
-          {'name': 'barrier reached', 'args' : {'barrier': 'barrier'}}])
+          {'name': 'barrier reached', 'args' : {'barrier': 'barrier'}}]),
+    Prog(['rwlock_barrier.c'],
+         ['-pthread'],
+         'chrome',
+         [{'name': 'read-locked by rw', 'args': {'lock': 'rw', 'kind': 'rwlock',
+                                                 'mode': 'shared'}},
+          {'name': 'write-locked by rw'},
+          {'name': 'spin-locked by sl'},
+          {'name': 'lock released', 'args': {'lock': 'rw'}},
+          {'name': 'barrier reached', 'args': {'barrier': 'b'}}],
+         ['--analyses', 'locks,barriers'])
 ]
 
 
@@ -129,6 +273,8 @@ def testProg(request):
 
 def test_smoke(testProg):
     "check POSIX thread create, join, mutex_lock and mutex_unlock are traced well"
+    if '--collector' not in testProg.options and shutil.which('gdb') is None:
+        pytest.skip('GDB is not installed')
     fd, tempFileName = tempfile.mkstemp()
     _, tempProfile = tempfile.mkstemp()
     os.close(fd)
@@ -142,20 +288,51 @@ def test_smoke(testProg):
                '../sync-prof',
                '--debug',
                '--output-format', testProg.outputType,
-               '--output', tempProfile,
-               tempFileName]
+               '--output', tempProfile] + \
+              testProg.options + \
+              [tempFileName]
         try:
             gdbOutput = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             assert e.returncode == 124, 'exit code not 124 (timeout)'
             gdbOutput = e.output
+        gdbOutput = gdbOutput.decode('utf-8', 'replace')
         # check there are no Python assertions in GDB's output
         assert not ('Python Exception' in gdbOutput), 'Python exception triggered'
         if testProg.outputType == 'text':
             checkText(testProg.expectedOutput, gdbOutput, tempProfile)
+        elif testProg.outputType == 'raw':
+            cmd = ['../sync-prof', 'replay',
+                   '--output-format', 'chrome',
+                   '--output', tempProfile + '.json',
+                   tempProfile]
+            try:
+                subprocess.check_call(cmd)
+                checkChrome(testProg.expectedOutput, tempProfile + '.json')
+            finally:
+                os.remove(tempProfile + '.json')
+        elif testProg.outputType == 'compact':
+            cmd = ['../sync-prof', 'pager',
+                   '--threads', '1,2',
+                   '--output', tempProfile + '.txt',
+                   tempProfile]
+            try:
+                subprocess.check_call(cmd)
+                checkRegexes(testProg.expectedOutput, tempProfile + '.txt')
+            finally:
+                os.remove(tempProfile + '.txt')
+        elif testProg.outputType in ['summary', 'flight']:
+            checkRegexes(testProg.expectedOutput, tempProfile)
+        elif testProg.outputType == 'flamegraph':
+            try:
+                checkRegexes(testProg.expectedOutput, tempProfile)
+                with open(tempProfile + '.html', 'r') as f:
+                    assert '<svg' in f.read(), 'no flame graph found'
+            finally:
+                os.remove(tempProfile + '.html')
         else:
             assert testProg.outputType == 'chrome'
-            checkChrome(testProg.expectedOutput, tempProfile)
+            checkChrome(testProg.expectedOutput, tempProfile, testProg.absentOutput)
     finally:
         os.remove(tempFileName)
         os.remove(tempProfile)
@@ -176,7 +353,15 @@ def checkText(expectedOutput, gdbOutput, tempProfile):
     assert not fourWaitSyncs in output, 'More than 3 levels of waiting syncs found'
 
 
-def checkChrome(expectedOutput, tempProfile):
+def checkRegexes(expectedOutput, path):
+    "check the regexes are found in a text output of sync-prof"
+    with open(path, 'r') as f:
+        output = f.read()
+    for s in expectedOutput:
+        assert re.search(s, output) is not None, '%s not found in %s' % (s, path)
+
+
+def checkChrome(expectedOutput, tempProfile, absentOutput=[]):
     "check chrome trace output of sync-prof"
     # check expected syncs are in the output
     with open(tempProfile, 'r') as f:
@@ -189,3 +374,10 @@ def checkChrome(expectedOutput, tempProfile):
                     index = expectedOutput.index(expEvent)
                     del expectedOutput[index]
     assert expectedOutput == [], 'Dictionaries %s were not found' % str(expectedOutput)
+    for event in eventList:
+        for absentEvent in absentOutput:
+            args = absentEvent.get('args', {})
+            absentEventMatches = \
+                all(i in event.items() for i in absentEvent.items() if i[0] != 'args') and \
+                all(i in event.get('args', {}).items() for i in args.items())
+            assert not absentEventMatches, 'Dictionary %s was found' % str(event)